@@ -0,0 +1,212 @@
+import click
+import importlib
+import itertools
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from datetime import datetime
+
+from stubs import MqttBrokerStub, OtpStubServer
+from synthetic import create_incidents, create_routes
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+feed = importlib.import_module('gtfs-incident-alerts.feed')
+geometry = importlib.import_module('gtfs-incident-alerts.geometry')
+matcher = importlib.import_module('gtfs-incident-alerts.matcher')
+mqtt = importlib.import_module('gtfs-incident-alerts.mqtt')
+
+STAGES = ['load', 'project', 'match', 'render', 'serialize', 'publish']
+
+
+def _measure(function, repeat, setup=None) -> tuple:
+    best = None
+    for _ in range(repeat):
+        arguments = setup() if setup is not None else tuple()
+
+        start = time.perf_counter()
+        result = function(*arguments)
+        duration = time.perf_counter() - start
+
+        best = duration if best is None else min(best, duration)
+
+    # peak memory is measured in a separate run, as tracing slows down the stage
+    arguments = setup() if setup is not None else tuple()
+
+    tracemalloc.start()
+    function(*arguments)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, best, peak
+
+def _run_scenario(pattern_count, points, incident_count, templates, repeat, seed, segments) -> dict:
+    routes = create_routes(pattern_count, points, seed)
+    geojson = create_incidents(routes, incident_count, seed)
+
+    with OtpStubServer(routes) as otp_stub, MqttBrokerStub() as mqtt_stub, tempfile.TemporaryDirectory() as temporary_dir:
+        alert_matcher = matcher.OtpGtfsMatcher(otp_stub.url, templates, pattern_cache=False)
+        date = datetime.now().strftime('%Y-%m-%d')
+
+        def load():
+            return alert_matcher._patterns._source.load_active_pattern(date)
+
+        def project(patterns):
+            return geometry.create_pattern_set_shapes(patterns)
+
+        def match(shapes):
+            incidents = [(i, alert_matcher._templates.find_template(i)) for i in geojson['features']]
+            incidents = [(i, t) for i, t in incidents if t is not None]
+
+            engine = geometry.create_engine(shapes, segments)
+            return incidents, engine.match(geometry.create_incident_shapes([i['geometry']['coordinates'] for i, _ in incidents]))
+
+        def render(patterns, incidents, incident_matches):
+            alerts = dict()
+            for (incident, template), pattern_indices in zip(incidents, incident_matches):
+                affected_routes = dict()
+                for pattern_index in pattern_indices:
+                    route = patterns.route(pattern_index)
+                    affected_routes.setdefault(route.gtfsId, route)
+
+                if len(affected_routes) > 0:
+                    alert_id, alert_entity = alert_matcher._create_service_alert(template, incident, **{
+                        'startLocationName': incident['properties']['from'],
+                        'endLocationName': incident['properties']['to'],
+                        'affectedLines': alert_matcher._natural_sort(list(affected_routes.values()), 'shortName')
+                    })
+
+                    alerts[alert_id] = alert_entity
+
+            return alerts
+
+        def setup_render():
+
+            # texts are cached across cycles, so each run starts with an empty cache
+            # and measures rendering them, like the first cycle with these incidents
+            alert_matcher._text_cache.clear()
+
+            return tuple()
+
+        def serialize(alerts):
+            return feed.create_feed_message(alerts).SerializeToString()
+
+        def setup_publish():
+            mirror_dir = tempfile.mkdtemp(dir=temporary_dir)
+            publisher = mqtt.GtfsRealtimeServiceAlertPublisher(mqtt_stub.host, mqtt_stub.port, None, None, '/bench/[alertId]', 600, mirror_dir)
+            publisher.start()
+
+            publishers.append(publisher)
+
+            return (publisher,)
+
+        def publish(publisher):
+            publisher.publish(alerts)
+
+        publishers = list()
+        stages = dict()
+
+        patterns, stages['load'], load_peak = _measure(load, repeat)
+        shapes, stages['project'], project_peak = _measure(lambda: project(patterns), repeat)
+        (incidents, incident_matches), stages['match'], match_peak = _measure(lambda: match(shapes), repeat)
+        alerts, stages['render'], render_peak = _measure(lambda: render(patterns, incidents, incident_matches), repeat, setup_render)
+        serialized, stages['serialize'], serialize_peak = _measure(lambda: serialize(alerts), repeat)
+        _, stages['publish'], publish_peak = _measure(publish, repeat, setup_publish)
+
+        for publisher in publishers:
+            publisher.stop()
+
+        alert_matcher.close()
+
+    peaks = [load_peak, project_peak, match_peak, render_peak, serialize_peak, publish_peak]
+    total = sum(stages.values())
+
+    return {
+        'patterns': len(patterns),
+        'points': points,
+        'incidents': incident_count,
+        'alerts': len(alerts),
+        'feed_bytes': len(serialized),
+        'stages': {stage: {'seconds': stages[stage], 'peak_bytes': peak} for stage, peak in zip(STAGES, peaks)},
+        'total_seconds': total,
+        'incidents_per_second': incident_count / total if total > 0 else None
+    }
+
+def _parse_list(value: str) -> list:
+    return [int(v) for v in value.split(',')]
+
+def _print_result(result: dict) -> None:
+    stages = ' '.join(f"{stage}={result['stages'][stage]['seconds'] * 1000:.1f}ms/{result['stages'][stage]['peak_bytes'] / 1048576:.1f}MB" for stage in STAGES)
+    click.echo(f"patterns={result['patterns']} points={result['points']} incidents={result['incidents']} alerts={result['alerts']} {stages} throughput={result['incidents_per_second']:.0f} incidents/s")
+
+
+@click.group()
+def cli():
+    pass
+
+@cli.command()
+@click.option('--patterns', '-p', default='500,2000', help='Comma-separated list of pattern counts')
+@click.option('--points', default='200', help='Comma-separated list of points per pattern')
+@click.option('--incidents', '-n', default='100,300', help='Comma-separated list of incident counts')
+@click.option('--templates', '-t', default='templates.yaml', help='YAML file containing text templates and their rules')
+@click.option('--repeat', '-r', default=3, help='Number of repetitions per stage, the best one is reported')
+@click.option('--seed', default=0, help='Seed for generating synthetic data')
+@click.option('--output', '-o', default='benchmark-results.json', help='Output JSON file for the results')
+@click.option('--segments', is_flag=True, default=False, help='Use the segment-level engine for matching')
+def run(patterns, points, incidents, templates, repeat, seed, output, segments):
+    results = list()
+    for pattern_count, point_count, incident_count in itertools.product(_parse_list(patterns), _parse_list(points), _parse_list(incidents)):
+        result = _run_scenario(pattern_count, point_count, incident_count, templates, repeat, seed, segments)
+        _print_result(result)
+
+        results.append(result)
+
+    with open(output, 'w', encoding='utf-8') as output_file:
+        output_file.write(json.dumps({
+            'created': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'seed': seed,
+            'repeat': repeat,
+            'segments': segments,
+            'results': results
+        }, indent=2))
+
+    click.echo(f"results written to {output}")
+
+@cli.command()
+@click.argument('baseline')
+@click.argument('candidate')
+def compare(baseline, candidate):
+    with open(baseline, 'r', encoding='utf-8') as baseline_file:
+        baseline_results = json.loads(baseline_file.read())['results']
+
+    with open(candidate, 'r', encoding='utf-8') as candidate_file:
+        candidate_results = json.loads(candidate_file.read())['results']
+
+    baseline_index = {(r['patterns'], r['points'], r['incidents']): r for r in baseline_results}
+    for candidate_result in candidate_results:
+        key = (candidate_result['patterns'], candidate_result['points'], candidate_result['incidents'])
+        if key not in baseline_index:
+            continue
+
+        baseline_result = baseline_index[key]
+
+        click.echo(f"patterns={key[0]} points={key[1]} incidents={key[2]}")
+        for stage in STAGES + ['total']:
+            if stage == 'total':
+                before, after = baseline_result['total_seconds'], candidate_result['total_seconds']
+            else:
+                before, after = baseline_result['stages'][stage]['seconds'], candidate_result['stages'][stage]['seconds']
+
+            ratio = after / before if before > 0 else float('inf')
+            click.echo(f"  {stage:<10} {before * 1000:10.1f}ms {after * 1000:10.1f}ms {ratio:6.2f}x")
+
+
+if __name__ == '__main__':
+    cli()
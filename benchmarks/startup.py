@@ -0,0 +1,137 @@
+import click
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules imported by each subcommand before it starts working and
+# heavy dependencies which must not be imported by them
+SCENARIOS = {
+    'cli': ([], ['shapely', 'pyproj', 'mako', 'numpy', 'paho', 'google.protobuf', 'httpx', 'requests']),
+    'fetch': (['adapter.tomtom'], ['shapely', 'pyproj', 'mako', 'numpy', 'paho', 'google.protobuf', 'httpx']),
+    'match': (['matcher'], ['pyproj', 'paho', 'google.protobuf', 'httpx', 'requests']),
+    'run': (['adapter.tomtom', 'matcher', 'daemon', 'httpserver', 'resources'], ['pyproj', 'paho', 'google.protobuf', 'httpx'])
+}
+
+
+def _measure_scenario(name: str, repeat: int) -> dict:
+    modules, forbidden = SCENARIOS[name]
+
+    code = ';'.join([
+        'import importlib, sys',
+        f"sys.path.insert(0, {ROOT!r})",
+        "importlib.import_module('gtfs-incident-alerts.__main__')"
+    ] + [f"importlib.import_module('gtfs-incident-alerts.{m}')" for m in modules])
+
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True, check=True)
+        duration = time.perf_counter() - start
+
+        if best is None or duration < best[0]:
+            best = (duration, process.stderr)
+
+    duration, importtime = best
+
+    # lines of -X importtime are formatted like 'import time: self | cumulative | name',
+    # nested imports are indented by two spaces per level
+    imports = list()
+    for line in importtime.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+
+        self_us, cumulative_us, module = line[len('import time:'):].split('|')
+        imports.append((module.strip(), len(module) - len(module.lstrip()) - 1, int(self_us), int(cumulative_us)))
+
+    imported = set(module for module, _, _, _ in imports)
+    violations = sorted(f for f in forbidden if any(m == f or m.startswith(f"{f}.") for m in imported))
+
+    top_level = sorted([i for i in imports if i[1] == 0], key=lambda i: i[3], reverse=True)
+
+    return {
+        'scenario': name,
+        'seconds': duration,
+        'import_seconds': sum(self_us for _, _, self_us, _ in imports) / 1000000,
+        'modules': len(imports),
+        'slowest': [{'module': module, 'seconds': cumulative_us / 1000000} for module, _, _, cumulative_us in top_level[:10]],
+        'violations': violations
+    }
+
+def _print_result(result: dict) -> None:
+    slowest = ' '.join(f"{s['module']}={s['seconds'] * 1000:.1f}ms" for s in result['slowest'][:5])
+    click.echo(f"{result['scenario']:<8} total={result['seconds'] * 1000:.1f}ms imports={result['import_seconds'] * 1000:.1f}ms modules={result['modules']} slowest: {slowest}")
+
+    if len(result['violations']) > 0:
+        click.echo(f"{result['scenario']:<8} imports {', '.join(result['violations'])}, which it must not import")
+
+
+@click.group()
+def cli():
+    pass
+
+@cli.command()
+@click.option('--scenarios', '-s', default=','.join(SCENARIOS.keys()), help='Comma-separated list of subcommands to measure')
+@click.option('--repeat', '-r', default=5, help='Number of interpreter starts per subcommand, the best one is reported')
+@click.option('--output', '-o', default='startup-results.json', help='Output JSON file for the results')
+def run(scenarios, repeat, output):
+    results = list()
+    for name in scenarios.split(','):
+        result = _measure_scenario(name, repeat)
+        _print_result(result)
+
+        results.append(result)
+
+    with open(output, 'w', encoding='utf-8') as output_file:
+        output_file.write(json.dumps({
+            'created': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'repeat': repeat,
+            'results': results
+        }, indent=2))
+
+    click.echo(f"results written to {output}")
+
+    # heavy imports in subcommands which do not need them are regressions
+    if any(len(r['violations']) > 0 for r in results):
+        sys.exit(1)
+
+@cli.command()
+@click.argument('baseline')
+@click.argument('candidate')
+@click.option('--threshold', default=1.25, help='Maximum ratio of candidate to baseline startup time')
+def compare(baseline, candidate, threshold):
+    with open(baseline, 'r', encoding='utf-8') as baseline_file:
+        baseline_results = json.loads(baseline_file.read())['results']
+
+    with open(candidate, 'r', encoding='utf-8') as candidate_file:
+        candidate_results = json.loads(candidate_file.read())['results']
+
+    regressions = list()
+
+    baseline_index = {r['scenario']: r for r in baseline_results}
+    for candidate_result in candidate_results:
+        if candidate_result['scenario'] not in baseline_index:
+            continue
+
+        before, after = baseline_index[candidate_result['scenario']]['seconds'], candidate_result['seconds']
+        ratio = after / before if before > 0 else float('inf')
+        click.echo(f"  {candidate_result['scenario']:<10} {before * 1000:10.1f}ms {after * 1000:10.1f}ms {ratio:6.2f}x")
+
+        if ratio > threshold:
+            regressions.append(candidate_result['scenario'])
+
+    if len(regressions) > 0:
+        click.echo(f"startup of {', '.join(regressions)} regressed by more than {threshold:.2f}x")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,125 @@
+import json
+import socket
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class OtpStubServer:
+
+    def __init__(self, routes: list):
+        self._routes = {route['gtfsId']: route for route in routes}
+        self._response_route_ids = json.dumps({'data': {'routeIds': [{'gtfsId': route_id} for route_id in self._routes.keys()]}}).encode('utf-8')
+
+        stub = self
+
+        class _RequestHandler(BaseHTTPRequestHandler):
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                if 'routeIds' in request['query']:
+                    response = stub._response_route_ids
+                else:
+                    response = stub._create_routes_response(request['variables'])
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), _RequestHandler)
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}/otp/gtfs/v1"
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, exception_type, exception_value, exception_traceback) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _create_routes_response(self, variables: dict) -> bytes:
+        routes = [self._routes[route_id] for route_id in variables['ids']]
+
+        # like OTP, patterns are filtered by their service dates on the server if requested,
+        # all synthetic patterns with trips are active
+        if 'serviceDates' in variables:
+            routes = [dict(route, patterns=[{'patternGeometry': p['patternGeometry']} for p in route['patterns'] if len(p['tripsForDate']) > 0]) for route in routes]
+
+        return json.dumps({'data': {'routes': routes}}).encode('utf-8')
+
+
+class MqttBrokerStub:
+
+    def __init__(self):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(('127.0.0.1', 0))
+        self._socket.listen(8)
+
+        self.host, self.port = self._socket.getsockname()
+        self.published_messages = 0
+        self.published_bytes = 0
+
+    def __enter__(self):
+        threading.Thread(target=self._accept, daemon=True).start()
+        return self
+
+    def __exit__(self, exception_type, exception_value, exception_traceback) -> None:
+        self._socket.close()
+
+    def _accept(self) -> None:
+        while True:
+            try:
+                connection, _ = self._socket.accept()
+            except OSError:
+                return
+
+            threading.Thread(target=self._handle, args=(connection,), daemon=True).start()
+
+    def _handle(self, connection: socket.socket) -> None:
+
+        # minimal MQTT v5 broker, accepts the connection and swallows all publishes
+        try:
+            while True:
+                packet_type = self._read(connection, 1)[0] >> 4
+
+                multiplier, length = 1, 0
+                while True:
+                    digit = self._read(connection, 1)[0]
+                    length = length + (digit & 127) * multiplier
+                    multiplier = multiplier * 128
+
+                    if digit & 128 == 0:
+                        break
+
+                payload = self._read(connection, length)
+
+                if packet_type == 1:
+                    connection.sendall(b'\x20\x03\x00\x00\x00')
+                elif packet_type == 3:
+                    self.published_messages = self.published_messages + 1
+                    self.published_bytes = self.published_bytes + len(payload)
+                elif packet_type == 12:
+                    connection.sendall(b'\xd0\x00')
+                elif packet_type == 14:
+                    break
+        except (EOFError, OSError):
+            pass
+        finally:
+            connection.close()
+
+    def _read(self, connection: socket.socket, length: int) -> bytes:
+        data = b''
+        while len(data) < length:
+            chunk = connection.recv(length - len(data))
+            if not chunk:
+                raise EOFError()
+
+            data = data + chunk
+
+        return data
@@ -0,0 +1,103 @@
+import math
+import polyline
+import random
+
+
+def create_routes(pattern_count: int, points_per_pattern: int, seed: int = 0) -> list:
+    generator = random.Random(seed)
+
+    # each route has up to four patterns, both directions and a short-turn variant
+    routes = list()
+    while sum(len(r['patterns']) for r in routes) < pattern_count:
+        route_index = len(routes)
+        coordinates = _create_random_walk(generator, points_per_pattern)
+
+        route = {
+            'gtfsId': f"bench:R{route_index}",
+            'shortName': str(route_index % 120),
+            'longName': f"Synthetic Line {route_index}",
+            'mode': 'BUS',
+            'type': 3,
+            'patterns': list()
+        }
+
+        variants = [coordinates, coordinates[::-1], coordinates[len(coordinates) // 4:], coordinates[:-len(coordinates) // 4]]
+        for variant in variants[:generator.randint(1, 4)]:
+            if sum(len(r['patterns']) for r in routes) + len(route['patterns']) >= pattern_count:
+                break
+
+            route['patterns'].append({
+                'patternGeometry': {
+                    'points': polyline.encode(variant)
+                },
+                'tripsForDate': [{'gtfsId': f"bench:T{route_index}-{i}"} for i in range(generator.randint(1, 8))]
+            })
+
+        routes.append(route)
+
+    return routes
+
+def create_incidents(routes: list, incident_count: int, seed: int = 0) -> dict:
+    generator = random.Random(seed)
+
+    codes = [201, 202, 203, 701, 1513, 1567, 101, 108, 401, 500]
+    features = list()
+    for index in range(incident_count):
+        kind = generator.random()
+
+        # most incidents follow a stretch of a pattern, some cross it or are far away
+        pattern = generator.choice(generator.choice(routes)['patterns'])
+        coordinates = [[lon, lat] for lat, lon in polyline.decode(pattern['patternGeometry']['points'])]
+
+        if kind < 0.7:
+            start = generator.randint(0, max(0, len(coordinates) - 3))
+            incident_coordinates = [[c[0] + generator.uniform(-0.00003, 0.00003), c[1] + generator.uniform(-0.00003, 0.00003)] for c in coordinates[start:start + generator.randint(2, 40)]]
+        elif kind < 0.9:
+            lon, lat = generator.choice(coordinates)
+            incident_coordinates = [[lon - 0.001, lat + 0.001], [lon + 0.001, lat - 0.001]]
+        else:
+            lon, lat = generator.choice(coordinates)
+            incident_coordinates = [[lon + 0.05, lat + 0.05], [lon + 0.051, lat + 0.051]]
+
+        if len(incident_coordinates) < 2:
+            incident_coordinates = coordinates[:2]
+
+        features.append({
+            'type': 'Feature',
+            'geometry': {
+                'type': 'LineString',
+                'coordinates': incident_coordinates
+            },
+            'properties': {
+                'id': f"bench-incident-{index}",
+                'events': [{'code': generator.choice(codes), 'description': 'synthetic'} for _ in range(generator.randint(1, 3))],
+                'startTime': '2025-01-01T00:00:00Z',
+                'endTime': '2025-12-31T23:59:59Z',
+                'from': f"Start {index}",
+                'to': f"End {index}",
+                'length': 100.0,
+                'delay': generator.choice([None, 120, 600, 1200]),
+                'timeValidity': 'present',
+                'probabilityOfOccurrence': 'certain'
+            }
+        })
+
+    return {
+        'type': 'FeatureCollection',
+        'features': features
+    }
+
+def _create_random_walk(generator: random.Random, points: int) -> list:
+    lat = 48.8 + generator.random() * 0.4
+    lon = 8.4 + generator.random() * 0.6
+    heading = generator.uniform(0, 2 * math.pi)
+
+    coordinates = list()
+    for _ in range(max(2, points)):
+        heading = heading + generator.uniform(-0.4, 0.4)
+        lat = lat + math.sin(heading) * 0.0004
+        lon = lon + math.cos(heading) * 0.0006
+
+        coordinates.append((round(lat, 5), round(lon, 5)))
+
+    return coordinates
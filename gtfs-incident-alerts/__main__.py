@@ -1,10 +1,15 @@
 import click
+import contextvars
 import json
 import logging
+import time
 
-from .adapter import tomtom
-from .matcher import OtpGtfsMatcher
-from .repeatedtimer import RepeatedTimer
+from datetime import datetime
+
+from .metrics import metrics
+
+# heavy dependencies like shapely, pyproj, mako, protobuf or paho-mqtt are only
+# imported by the subcommands and output modes which need them, see benchmarks/startup.py
 
 logging.basicConfig(
     level=logging.INFO, 
@@ -13,16 +18,163 @@ logging.basicConfig(
 )
 
 
-def _run_fetch_match(source, bbox, key, url, templates, output, mqtt, expiration):
-    if source == 'tomtom':
-        adapter = tomtom.Adapter(key)
-        geojson = adapter.fetch(bbox)
+def _parse_tiles(tiles):
+    columns, rows = tiles.lower().split('x')
+    return int(columns), int(rows)
+
+_job_defaults = {
+    'source': 'tomtom',
+    'key': None,
+    'bbox': None,
+    'tiles': '1x1',
+    'url': '',
+    'gtfs': None,
+    'templates': 'templates.yaml',
+    'output': None,
+    'mqtt': None,
+    'expiration': 600,
+    'interval': 300,
+    'deadline': None,
+    'jitter': 0.0,
+    'incremental': False,
+    'stream': False,
+    'serve': None,
+    'serve_path': '/',
+    'segments': False,
+    'simplify': 0.0,
+    'buffer_size': 5.0,
+    'min_overlap': 40.0,
+    'merge_tolerance': 0.0,
+    'differential': False,
+    'snapshot_interval': 3600
+}
+
+def _run_fetch_match(name, adapter, bbox, matcher, output, mqtt, expiration, feed_endpoint, stream, deadline):
+    metrics.start_cycle(name)
+    try:
+        _fetch_match(adapter, bbox, matcher, output, mqtt, expiration, feed_endpoint, stream, deadline)
+    finally:
+        # emit one machine-readable stats line per cycle
+        logging.info(f"cycle stats {json.dumps({'job': name, **metrics.end_cycle()}, sort_keys=True)}")
+
+def _fetch_match(adapter, bbox, matcher, output, mqtt, expiration, feed_endpoint, stream, deadline):
+
+    # requests time out at the deadline of the cycle, as cycles of a job never
+    # overlap and a stalled connection would block the job otherwise
+
+    # streamed incidents are matched while they're fetched
+    if stream:
+        with metrics.stage('patterns'):
+            matcher.load_patterns(deadline)
+
+        geojson = {'type': 'FeatureCollection', 'features': adapter.stream(bbox, deadline)}
+    else:
+        geojson = _fetch(adapter, bbox, matcher, deadline)
+
+    if geojson is not None:
+        if time.monotonic() > deadline:
+            logging.error('cycle deadline exceeded after fetching incidents, skipping matching')
+            return
+
+        alerts = matcher.match(geojson, output, mqtt, expiration, deadline)
+
+        if alerts is not None and feed_endpoint is not None:
+            with metrics.stage('serve'):
+                if feed_endpoint.update(alerts):
+                    logging.info("served feed updated")
+
+def _fetch(adapter, bbox, matcher, deadline):
+    from concurrent.futures import ThreadPoolExecutor
+
+    # load patterns while fetching incidents, within the context of the current cycle
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        patterns_loaded = executor.submit(contextvars.copy_context().run, metrics.stage('patterns')(matcher.load_patterns), deadline)
+        with metrics.stage('fetch'):
+            geojson = adapter.fetch(bbox, deadline=deadline)
+
+        patterns_loaded.result()
+
+    return geojson
 
-        if geojson is not None:
-            matcher = OtpGtfsMatcher(url, templates)
-            matcher.match(geojson, output, mqtt, expiration)
+def _get_server(servers, address):
+    from .httpserver import HttpServer
+
+    # endpoints with the same address share one server
+    if address not in servers:
+        servers[address] = HttpServer(address)
+
+    return servers[address]
+
+def _route_metrics(servers, address):
+    from .httpserver import HttpResponse
+
+    _get_server(servers, address).route('/metrics', lambda request: HttpResponse(200, metrics.render().encode('utf-8'), {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}))
+
+def _create_matcher(url, gtfs, templates, pattern_cache, workers, segments, simplify, buffer_size, min_overlap, merge_tolerance, differential, snapshot_interval, incremental=False):
+    from .matcher import OtpGtfsMatcher
+
+    return OtpGtfsMatcher(url, templates, pattern_cache, incremental, workers, gtfs, segments=segments, simplify_tolerance=simplify, buffer_size=buffer_size, min_overlap=min_overlap, merge_tolerance=merge_tolerance, differential=differential, snapshot_interval=snapshot_interval)
+
+def _create_job(resources, servers, *, name, source, key, bbox, tiles, url, gtfs, templates, output, interval, mqtt, expiration, segments, simplify, buffer_size, min_overlap, merge_tolerance, differential, snapshot_interval, incremental, deadline, jitter, stream, serve, serve_path):
+    from .adapter import tomtom
+    from .daemon import Job
+    from .matcher import OtpGtfsMatcher
+
+    if source == 'tomtom':
+        adapter = tomtom.Adapter(key, _parse_tiles(tiles))
     else:
         logging.error(f"unknown source type {source}")
+        return None, None
+
+    # adapter, matcher and MQTT connection are kept alive during runtime
+    matcher = OtpGtfsMatcher(url, templates, incremental=incremental, gtfs_filename=gtfs, segments=segments, simplify_tolerance=simplify, buffer_size=buffer_size, min_overlap=min_overlap, merge_tolerance=merge_tolerance, differential=differential, snapshot_interval=snapshot_interval, interval=interval + jitter, resources=resources)
+
+    feed_endpoint = None
+    if serve is not None:
+        from .feedendpoint import FeedEndpoint
+
+        feed_endpoint = FeedEndpoint()
+        _get_server(servers, serve).route(serve_path, feed_endpoint.handle)
+
+    job = Job(name, interval, _run_fetch_match, name, adapter, bbox, matcher, output, mqtt, expiration, feed_endpoint, stream, deadline=deadline, jitter=jitter)
+
+    return job, matcher
+
+
+def _matcher_options(function):
+
+    # options of all commands matching incidents, so that they can't drift apart
+    options = [
+        click.option('--url', '-u', default='', help='OpenTripPlanner GraphQL GTFS endpoint for requesting GTFS data'),
+        click.option('--gtfs', '-f', default=None, help='Static GTFS file to read patterns from instead of OpenTripPlanner'),
+        click.option('--templates', '-t', default='templates.yaml', help='YAML file containing text templates and their rules'),
+        click.option('--pattern-cache/--no-pattern-cache', default=True, help='Cache projected pattern geometries per operation day on disk'),
+        click.option('--workers', '-w', default=1, help='Number of worker processes for matching incidents against patterns'),
+        click.option('--segments', is_flag=True, default=False, help='Match incidents against the segments of patterns and determine the overlapping stretches'),
+        click.option('--simplify', default=0.0, help='Tolerance in meters for simplifying pattern geometries, only used with --segments'),
+        click.option('--buffer-size', default=5.0, help='Buffer size in meters around incidents'),
+        click.option('--min-overlap', default=40.0, help='Minimum overlap in meters of a pattern with a buffered incident'),
+        click.option('--merge-tolerance', default=0.0, help='Tolerance in meters for merging similar pattern geometries before matching'),
+        click.option('--differential', is_flag=True, default=False, help='Write only changed and deleted alerts to the output file'),
+        click.option('--snapshot-interval', default=3600, help='Interval in seconds of full snapshots in differential output files')
+    ]
+
+    for option in reversed(options):
+        function = option(function)
+
+    return function
+
+def _output_options(function):
+    options = [
+        click.option('--output', '-o', default=None, help='Output protobuf or JSON file for generated service alerts'),
+        click.option('--mqtt', '-m', default=None, help='MQTT connection and topic URI'),
+        click.option('--expiration', '-e', default=600, help='MQTT message expiration time. Only used in MQTT publishing')
+    ]
+
+    for option in reversed(options):
+        function = option(function)
+
+    return function
 
 
 @click.group()
@@ -33,66 +185,171 @@ def cli():
 @click.option('--source', '-s', default='tomtom', help='Datasource type for generating GeoJSON file')
 @click.option('--bbox', '-b', help='Bounding box as list of two tuples to load incident data for')
 @click.option('--key', '-k', help='An optional API key')
-@click.option('--geojson', '-g', default='incidents.geojson', help='Output filename for GeoJSON file')
-def fetch(geojson, source, bbox, key):
+@click.option('--geojson', '-g', default='incidents.geojson', help='Output filename for GeoJSON file, [timestamp] is replaced by the current time')
+@click.option('--tiles', default='1x1', help='Grid of tiles the bounding box is split into, e.g. 2x2')
+def fetch(geojson, source, bbox, key, tiles):
+    from .adapter import tomtom
 
     if source == 'tomtom':
-        adapter = tomtom.Adapter(key)
-        adapter.fetch(bbox, geojson)
+        adapter = tomtom.Adapter(key, _parse_tiles(tiles))
+        adapter.fetch(bbox, geojson.replace('[timestamp]', datetime.now().strftime('%Y%m%dT%H%M%S')))
     else:
         logging.error(f"unknown source type {source}")
 
 @cli.command()
-@click.option('--url', '-u', default='', help='OpenTripPlanner GraphQL GTFS endpoint for requesting GTFS data')
 @click.option('--geojson', '-g', help='Input GeoJSON file with incident data')
-@click.option('--templates', '-t', default='templates.yaml', help='YAML file containing text templates and their rules')
-@click.option('--output', '-o', default=None, help='Output protobuf or JSON file for generated service alerts')
-@click.option('--mqtt', '-m', default=None, help='MQTT connection and topic URI')
-@click.option('--expiration', '-e', default=600, help='MQTT message expiration time. Only used in MQTT publishing')
-def match(url, geojson, templates, output, mqtt, expiration):
-    
+@_matcher_options
+@_output_options
+def match(geojson, output, mqtt, expiration, **matcher_options):
     if output is None and mqtt is None:
         logging.error('either --output/-o or --mqtt/-m must be specified')
         return
 
-    matcher = OtpGtfsMatcher(url, templates)
-    matcher.match(geojson, output, mqtt, expiration)
+    matcher = _create_matcher(**matcher_options)
+    try:
+        matcher.match(geojson, output, mqtt, expiration)
+    finally:
+        matcher.close()
 
 @cli.command()
 @click.option('--geojson', '-g', help='GeoJSON datasource with incident data')
-@click.option('--url', '-u', default='', help='OpenTripPlanner GraphQL GTFS endpoint for requesting GTFS data')
-@click.option('--templates', '-t', default='templates.yaml', help='YAML file containing text templates and their rules')
-@click.option('--output', '-o', help='Output protobuf or JSON file for generated service alerts')
-@click.option('--mqtt', '-m', default=None, help='MQTT connection and topic URI')
-@click.option('--expiration', '-e', default=600, help='MQTT message expiration time. Only used in MQTT publishing')
-def simulation(geojson, url, templates, output, mqtt, expiration):
-    
+@_matcher_options
+@_output_options
+def simulation(geojson, output, mqtt, expiration, **matcher_options):
     with open(geojson, 'r', encoding='utf-8') as geojson_file:
         geojson_data = json.loads(geojson_file.read())
     
-    matcher = OtpGtfsMatcher(url, templates)
-    matcher.match(geojson_data, output, mqtt, expiration)
+    matcher = _create_matcher(**matcher_options)
+    try:
+        matcher.match(geojson_data, output, mqtt, expiration)
+    finally:
+        matcher.close()
+
+@cli.command()
+@click.option('--snapshots', '-g', help='Directory or ZIP/TAR archive of timestamped GeoJSON snapshots')
+@_matcher_options
+@_output_options
+@click.option('--incremental', is_flag=True, default=False, help='Reuse match results of unchanged incidents from the previous cycle')
+@click.option('--speed', '-x', default=0.0, help='Speed-up factor relative to the snapshot timestamps, 0 replays as fast as possible')
+@click.option('--report', '-r', default=None, help='Output JSON file for the replay report')
+def replay(snapshots, output, mqtt, expiration, incremental, speed, report, **matcher_options):
+    from .replay import Replay
+
+    matcher = _create_matcher(incremental=incremental, **matcher_options)
+    try:
+        replay_report = Replay(snapshots, speed).run(matcher, output, mqtt, expiration)
+    finally:
+        matcher.close()
+
+    summary = replay_report['summary']
+    logging.info(f"replayed {summary['cycles']} snapshots with {summary['incidents']} incidents in {summary['processing_duration']:.3f}s, {summary['incidents_per_second']} incidents/s")
+    logging.info(f"alerts created: {summary['alerts_created']}, changed: {summary['alerts_changed']}, deleted: {summary['alerts_deleted']}")
+    if 'latency' in summary:
+        logging.info(f"cycle latency {json.dumps(summary['latency'], sort_keys=True)}")
+
+    if report is not None:
+        with open(report, 'w', encoding='utf-8') as report_file:
+            report_file.write(json.dumps(replay_report, indent=2))
 
 @cli.command()
 @click.option('--source', '-s', default='tomtom', help='Datasource type for generating GeoJSON file')
 @click.option('--bbox', '-b', help='Bounding box as list of two tuples to load incident data for')
 @click.option('--key', '-k', help='An optional API key')
-@click.option('--url', '-u', default='', help='OpenTripPlanner GraphQL GTFS endpoint for requesting GTFS data')
-@click.option('--templates', '-t', default='templates.yaml', help='YAML file containing text templates and their rules')
-@click.option('--output', '-o', default=None, help='Output protobuf or JSON file for generated service alerts')
+@_matcher_options
+@_output_options
 @click.option('--interval', '-i', default=300, help='Update frequency interval')
-@click.option('--mqtt', '-m', default=None, help='MQTT connection and topic URI')
-@click.option('--expiration', '-e', default=600, help='MQTT message expiration time. Only used in MQTT publishing')
-def run(source, bbox, key, url, templates, output, interval, mqtt, expiration):
-    timer = RepeatedTimer(interval, _run_fetch_match, source, bbox, key, url, templates, output, mqtt, expiration)
-    timer.start_immediately()
-    
+@click.option('--incremental', is_flag=True, default=False, help='Reuse match results of unchanged incidents from the previous cycle')
+@click.option('--deadline', '-d', default=None, type=float, help='Maximum duration of a single cycle in seconds, defaults to the interval')
+@click.option('--jitter', '-j', default=0.0, help='Maximum random delay in seconds added to each interval')
+@click.option('--tiles', default='1x1', help='Grid of tiles the bounding box is split into, e.g. 2x2')
+@click.option('--stream', is_flag=True, default=False, help='Match incidents while they are fetched instead of fetching them completely first')
+@click.option('--serve', default=None, help='Address to serve the GTFS-RT feed on, e.g. 0.0.0.0:8080')
+@click.option('--serve-path', default='/', help='Path the GTFS-RT feed is served at')
+@click.option('--pattern-refresh', default=3600.0, help='Interval in seconds after which loaded patterns are checked against their source for changes')
+@click.option('--metrics', 'metrics_address', default=None, help='Address to serve Prometheus metrics on, e.g. localhost:9100')
+@click.option('--profile', default=None, help='Write a cProfile of the first cycle and of each cycle after SIGUSR1 to this file')
+def run(pattern_cache, workers, pattern_refresh, metrics_address, profile, **job_options):
+    from .daemon import Daemon
+    from .resources import SharedResources
+
+    # the remaining options are the same as those of a job in a jobs file
+    resources = SharedResources(pattern_cache, workers, pattern_refresh)
+    servers = dict()
+
+    job, matcher = _create_job(resources, servers, name='default', **job_options)
+    if job is None:
+        resources.close()
+        return
+
+    if metrics_address is not None:
+        _route_metrics(servers, metrics_address)
+
+    daemon = Daemon([job], list(servers.values()), profile)
+    try:
+        daemon.run()
+    finally:
+        matcher.close()
+        resources.close()
+
+@cli.command()
+@click.option('--config', '-c', default='jobs.yaml', help='YAML file defining region jobs and their options')
+def jobs(config):
+    import yaml
+
+    from .daemon import Daemon
+    from .resources import SharedResources
+
+    with open(config, 'r', encoding='utf-8') as config_file:
+        job_config = yaml.safe_load(config_file.read())
+
+    # options of each job default to the options of the run command,
+    # which can be overridden for all jobs in the defaults section
+    job_definitions = list()
+    for job_definition in job_config.get('jobs', list()):
+        job_definition = {**_job_defaults, **job_config.get('defaults', dict()), **job_definition}
+
+        unknown_options = set(job_definition.keys()) - set(_job_defaults.keys()) - {'name'}
+        if len(unknown_options) > 0:
+            logging.error(f"unknown options {', '.join(sorted(unknown_options))} in job {job_definition.get('name')}")
+            return
+
+        if 'name' not in job_definition or job_definition['name'] in [d['name'] for d in job_definitions]:
+            logging.error("each job needs a unique name")
+            return
+
+        if job_definition['output'] is None and job_definition['mqtt'] is None and job_definition['serve'] is None:
+            logging.error(f"job {job_definition['name']} needs either output, mqtt or serve")
+            return
+
+        job_definitions.append(job_definition)
+
+    # jobs with the same patterns, templates or MQTT broker share them
+    resources = SharedResources(job_config.get('pattern_cache', True), job_config.get('workers', 1), job_config.get('pattern_refresh', 3600))
+    servers = dict()
+
+    jobs = list()
+    matchers = list()
     try:
-        while True:
-            pass
-    except KeyboardInterrupt:
-        timer.stop()
+        for job_definition in job_definitions:
+            job, matcher = _create_job(resources, servers, **job_definition)
+            if job is None:
+                return
+
+            jobs.append(job)
+            matchers.append(matcher)
+
+        if job_config.get('metrics') is not None:
+            _route_metrics(servers, job_config['metrics'])
+
+        logging.info(f"running {len(jobs)} jobs")
+
+        daemon = Daemon(jobs, list(servers.values()), job_config.get('profile'), job_config.get('concurrency'))
+        daemon.run()
+    finally:
+        for matcher in matchers:
+            matcher.close()
 
+        resources.close()
 
 if __name__ == '__main__':
     cli()
\ No newline at end of file
@@ -1,11 +1,21 @@
+import gzip
+import ijson
+import io
 import json
 import logging
+import os
 import requests
+import time
+import urllib3
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 
 
 class Adapter:
 
-    def __init__(self, key):
+    def __init__(self, key, tiles=(1, 1), max_workers=4, timeout=(10.0, 60.0)):
         self._api_version = 5
         self._api_lang = 'en-US'
         self._api_categories = '0,1,2,5,6,10,11'
@@ -38,30 +48,204 @@ class Adapter:
 
         self._api_key = key
 
-    def fetch(self, bbox, output_filename=None) -> dict | None:
+        self._tiles = tiles
+        self._max_workers = max_workers
+
+        # connect and read timeout of each request, so that a stalled
+        # connection does not block the cycle forever
+        self._timeout = timeout
+
+        # use a pooled HTTP session for all requests
+        self._session = requests.Session()
+        self._session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=max_workers))
+
+        # validators and the compressed body of the last response of each tile for conditional requests,
+        # only kept if the API responded with an ETag or Last-Modified header
+        self._tile_validators = dict()
+
+    def stream(self, bbox, deadline=None):
+
+        # tiles are streamed one after another, so that only a single response
+        # is parsed at a time and incidents are passed on one by one
+        incident_ids = set()
+        for tile_bbox in self._create_tiles(bbox):
+            for incident in self._stream_tile(tile_bbox, deadline):
+                if incident['properties']['id'] not in incident_ids:
+                    incident_ids.add(incident['properties']['id'])
+                    yield incident
+
+    def fetch(self, bbox, output_filename=None, deadline=None) -> dict | None:
+        if output_filename is not None:
+            try:
+                self._write_incidents(self.stream(bbox, deadline), output_filename)
+            except (RuntimeError, requests.RequestException, urllib3.exceptions.HTTPError, ijson.JSONError) as ex:
+                logging.error(f"could not fetch incidents: {ex}")
+
+            return None
+
+        # split the bbox into tiles and fetch them concurrently
+        tile_bboxes = self._create_tiles(bbox)
+        if len(tile_bboxes) == 1:
+            tile_results = [self._fetch_tile(tile_bboxes[0], deadline)]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self._max_workers, len(tile_bboxes))) as executor:
+                tile_results = list(executor.map(self._fetch_tile, tile_bboxes, [deadline] * len(tile_bboxes)))
+
+        if any(incidents is None for incidents in tile_results):
+            return None
+
+        # merge all tiles, incidents crossing tile borders are contained 
+        # in multiple tiles and need to be added only once
+        json_response = dict()
+        json_response['type'] = 'FeatureCollection'
+        json_response['features'] = list()
+
+        incident_ids = set()
+        for incidents in tile_results:
+            for incident in incidents:
+                if incident['properties']['id'] not in incident_ids:
+                    incident_ids.add(incident['properties']['id'])
+                    json_response['features'].append(incident)
+
+        return json_response
+
+    def _write_incidents(self, incidents, output_filename) -> None:
+
+        # incidents are written one by one to a temporary file,
+        # which replaces the output file only if all tiles were fetched
+        temporary_filename = f"{output_filename}.tmp"
+        try:
+            with open(temporary_filename, 'w', encoding='utf-8') as output_file:
+                output_file.write('{"type": "FeatureCollection", "features": [')
+                for index, incident in enumerate(incidents):
+                    if index > 0:
+                        output_file.write(', ')
+
+                    output_file.write(json.dumps(incident))
+
+                output_file.write(']}')
+
+            os.replace(temporary_filename, output_filename)
+        finally:
+            if os.path.exists(temporary_filename):
+                os.remove(temporary_filename)
+
+    def _create_tiles(self, bbox) -> list:
+        columns, rows = self._tiles
+        if columns * rows == 1:
+            return [bbox]
+
+        min_lon, min_lat, max_lon, max_lat = [float(c) for c in bbox.split(',')]
+        tile_width = (max_lon - min_lon) / columns
+        tile_height = (max_lat - min_lat) / rows
+
+        tile_bboxes = list()
+        for row in range(rows):
+            for column in range(columns):
+                tile_bboxes.append(','.join([
+                    str(min_lon + column * tile_width),
+                    str(min_lat + row * tile_height),
+                    str(min_lon + (column + 1) * tile_width),
+                    str(min_lat + (row + 1) * tile_height)
+                ]))
+
+        return tile_bboxes
+
+    def _fetch_tile(self, bbox, deadline=None) -> list | None:
+        try:
+            return list(self._stream_tile(bbox, deadline))
+        except (RuntimeError, requests.RequestException, urllib3.exceptions.HTTPError, ijson.JSONError) as ex:
+            logging.error(f"could not fetch incidents: {ex}")
+            return None
+
+    def _stream_tile(self, bbox, deadline=None):
 
         request_fields = self._api_query.replace('\n', ' ').replace('\r', '').replace('\t', '').replace(' ', '')
         request_url = f"https://api.tomtom.com/traffic/services/{self._api_version}/incidentDetails?key={self._api_key}&bbox={bbox}&language={self._api_lang}&fields={request_fields}&categoryFilter={self._api_categories}"
 
         logging.info(f"HTTP Request: GET {request_url}")
 
-        response = requests.get(request_url)
-        if response.status_code == 200:
-            json_response = json.loads(response.text)
+        request_headers = {'Accept-Encoding': 'gzip'}
+
+        tile_validators = self._tile_validators.get(bbox)
+        if tile_validators is not None:
+            etag, last_modified, _ = tile_validators
+            if etag is not None:
+                request_headers['If-None-Match'] = etag
+            if last_modified is not None:
+                request_headers['If-Modified-Since'] = last_modified
+
+        with self._session.get(request_url, headers=request_headers, stream=True, timeout=self._get_timeout(deadline)) as response:
+            if response.status_code == 304 and tile_validators is not None:
+                logging.info(f"TomTom API incidents of {bbox} not modified")
+
+                with gzip.GzipFile(fileobj=io.BytesIO(tile_validators[2])) as body:
+                    yield from ijson.items(body, 'incidents.item', use_float=True)
+
+                return
+
+            if response.status_code != 200:
+                logging.info(response.text)
+                raise RuntimeError(f"TomTom API response status code {response.status_code}")
 
-            json_response['type'] = 'FeatureCollection'
-            json_response['features'] = json_response['incidents']
-            del json_response['incidents']
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
 
-            if output_filename is not None:
-                with open(output_filename, 'w', encoding='utf-8') as output_file:
-                    output_file.write(json.dumps(json_response))
+            # parse incidents one by one directly from the (decompressed) response stream,
+            # the body is only recorded if it can be reused for conditional requests
+            response.raw.decode_content = True
+            body = _DeadlineReader(response.raw, deadline) if deadline is not None else response.raw
+            body = _RecordingReader(body) if etag is not None or last_modified is not None else body
+
+            yield from ijson.items(body, 'incidents.item', use_float=True)
+
+            if isinstance(body, _RecordingReader):
+                self._tile_validators[bbox] = (etag, last_modified, body.recording())
             else:
-                return json_response
-        
-        else:
-            logging.error(f"TomTom API response status code {response.status_code}")
-            logging.info(response.text)
+                self._tile_validators.pop(bbox, None)
+
+    def _get_timeout(self, deadline) -> tuple:
+        connect_timeout, read_timeout = self._timeout
+        if deadline is None:
+            return connect_timeout, read_timeout
+
+        # requests must not take longer than the remainder of the cycle
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise requests.Timeout('cycle deadline exceeded before requesting incidents')
+
+        return min(connect_timeout, remaining), min(read_timeout, remaining)
+
+
+class _DeadlineReader:
+
+    def __init__(self, stream, deadline):
+        self._stream = stream
+        self._deadline = deadline
+
+    def read(self, size: int = -1) -> bytes:
+
+        # the read timeout applies to each read, a slowly
+        # trickling response is stopped at the deadline
+        if time.monotonic() > self._deadline:
+            raise requests.Timeout('cycle deadline exceeded while reading incidents')
+
+        return self._stream.read(size)
+
+
+class _RecordingReader:
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._compressor = zlib.compressobj(1, zlib.DEFLATED, 31)
+        self._chunks = list()
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._stream.read(size)
+        if data:
+            self._chunks.append(self._compressor.compress(data))
+
+        return data
 
-            if output_filename is None:
-                return None
+    def recording(self) -> bytes:
+        return b''.join(self._chunks) + self._compressor.flush()
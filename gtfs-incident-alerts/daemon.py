@@ -0,0 +1,124 @@
+import asyncio
+import cProfile
+import logging
+import random
+import signal
+import time
+
+
+class Job:
+
+    def __init__(self, name: str, interval: float, function, *args, deadline: float = None, jitter: float = 0.0, **kwargs):
+        self.name       = name
+        self.interval   = interval
+        self.deadline   = deadline if deadline is not None else interval
+        self.jitter     = jitter
+        self.function   = function
+        self.args       = args
+        self.kwargs     = kwargs
+
+
+class Daemon:
+
+    def __init__(self, jobs: list, servers: list = None, profile_filename: str = None, concurrency: int = None):
+        self.jobs       = jobs
+        self.servers    = servers if servers is not None else list()
+
+        # the number of cycles running at the same time is bounded,
+        # so that many jobs do not compete for the same resources
+        self.concurrency = concurrency if concurrency is not None else len(jobs)
+
+        # the first cycle is profiled if a profile filename is given,
+        # further cycles can be profiled on demand by sending SIGUSR1
+        self.profile_filename = profile_filename
+        self._profile_requested = profile_filename is not None
+
+        self._shutdown = None
+        self._semaphore = None
+
+    def run(self) -> None:
+        try:
+            asyncio.run(self._run())
+        except KeyboardInterrupt:
+            pass
+
+    def stop(self) -> None:
+        if self._shutdown is not None:
+            self._shutdown.set()
+
+    def request_profile(self) -> None:
+        if self.profile_filename is not None:
+            logging.info('profiling next cycle ...')
+            self._profile_requested = True
+
+    async def _run(self) -> None:
+        self._shutdown = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(max(1, self.concurrency))
+
+        loop = asyncio.get_running_loop()
+        for shutdown_signal in [signal.SIGINT, signal.SIGTERM]:
+            try:
+                loop.add_signal_handler(shutdown_signal, self.stop)
+            except NotImplementedError:
+                pass
+
+        if hasattr(signal, 'SIGUSR1'):
+            loop.add_signal_handler(signal.SIGUSR1, self.request_profile)
+
+        for server in self.servers:
+            await server.start()
+
+        await asyncio.gather(*[self._run_job(job) for job in self.jobs])
+
+        logging.info('shutting down ...')
+
+        for server in self.servers:
+            await server.stop()
+
+    async def _run_job(self, job: Job) -> None:
+        loop = asyncio.get_running_loop()
+
+        next_start = loop.time()
+        while not self._shutdown.is_set():
+            async with self._semaphore:
+                await self._run_cycle(job)
+
+            # schedule the next cycle relative to the start of the current one
+            # if a cycle took longer than the interval, the next one starts right after it
+            # this way, cycles of the same job never overlap
+            next_start = next_start + job.interval
+            if next_start < loop.time():
+                logging.warning(f"cycle of {job.name} took longer than the interval of {job.interval}s")
+                next_start = loop.time()
+
+            delay = next_start - loop.time() + random.uniform(0.0, job.jitter)
+
+            try:
+                await asyncio.wait_for(self._shutdown.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run_cycle(self, job: Job) -> None:
+        start = time.monotonic()
+        deadline = start + job.deadline
+
+        try:
+            if self._profile_requested:
+                self._profile_requested = False
+                await asyncio.to_thread(self._run_profiled, job, deadline)
+            else:
+                await asyncio.to_thread(job.function, *job.args, deadline=deadline, **job.kwargs)
+        except Exception as ex:
+            logging.exception(ex)
+
+        duration = time.monotonic() - start
+        if duration > job.deadline:
+            logging.warning(f"cycle of {job.name} exceeded its deadline of {job.deadline}s after {duration:.1f}s")
+
+    def _run_profiled(self, job: Job, deadline: float) -> None:
+        profile = cProfile.Profile()
+        try:
+            profile.runcall(job.function, *job.args, deadline=deadline, **job.kwargs)
+        finally:
+            profile.dump_stats(self.profile_filename)
+            logging.info(f"cycle profile of {job.name} written to {self.profile_filename}")
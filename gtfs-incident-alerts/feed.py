@@ -0,0 +1,163 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+from google.transit import gtfs_realtime_pb2
+
+
+def create_feed_message(alerts: dict, incrementality: str = 'FULL_DATASET', deleted_alerts: dict = None) -> gtfs_realtime_pb2.FeedMessage:
+    feed_message = gtfs_realtime_pb2.FeedMessage()
+    feed_message.header.gtfs_realtime_version = '2.0'
+    feed_message.header.incrementality = gtfs_realtime_pb2.FeedHeader.Incrementality.Value(incrementality)
+    feed_message.header.timestamp = int(time.time())
+
+    for alert_id, alert_entity in alerts.items():
+        entity = feed_message.entity.add()
+        entity.id = alert_id
+
+        _fill_alert(entity.alert, alert_entity)
+
+    if deleted_alerts is not None:
+        for alert_id, alert_entity in deleted_alerts.items():
+            entity = feed_message.entity.add()
+            entity.id = alert_id
+            entity.is_deleted = True
+
+            # tombstones may consist of their ID only
+            if alert_entity is not None:
+                _fill_alert(entity.alert, alert_entity)
+
+    return feed_message
+
+def create_feed_dict(alerts: dict, incrementality: str = 'FULL_DATASET', deleted_alert_ids: list = None) -> dict:
+    feed_message = dict()
+    feed_message['header'] = {
+        'gtfs_realtime_version': '2.0',
+        'incrementality': incrementality,
+        'timestamp': int(time.time())
+    }
+
+    feed_message['entity'] = list()
+    for alert_id, alert_entity in alerts.items():
+        feed_message['entity'].append({
+            'id': alert_id,
+            'alert': alert_entity
+        })
+
+    if deleted_alert_ids is not None:
+        for alert_id in deleted_alert_ids:
+            feed_message['entity'].append({
+                'id': alert_id,
+                'is_deleted': True
+            })
+
+    return feed_message
+
+def create_feed_digest(alerts: dict) -> str:
+    return hashlib.sha256(json.dumps(alerts, sort_keys=True).encode('utf-8')).hexdigest()
+
+def write_feed_file(alerts: dict, output_filename: str) -> bool:
+
+    # the digest of the last written alerts is kept in a sidecar file
+    # the output file is only rewritten if the alerts have changed
+    digest = create_feed_digest(alerts)
+    digest_filename = f"{output_filename}.etag"
+
+    if os.path.exists(output_filename) and os.path.exists(digest_filename):
+        with open(digest_filename, 'r') as digest_file:
+            if digest_file.read().strip() == digest:
+                return False
+
+    if output_filename.endswith('.json'):
+        content = json.dumps(create_feed_dict(alerts), indent=2, ensure_ascii=False).encode('utf-8')
+    elif output_filename.endswith('.pbf'):
+        content = create_feed_message(alerts).SerializeToString()
+    else:
+        logging.error(f"unknown output file type of {output_filename}")
+        return False
+
+    # write to a temporary file and replace the output file atomically
+    # so that consumers never read a partially written feed
+    _write_atomically(output_filename, content)
+    _write_atomically(digest_filename, digest.encode('utf-8'))
+
+    return True
+
+def write_differential_feed_file(alerts: dict, output_filename: str, snapshot_interval: int) -> bool:
+
+    # the digest of each alert written before is kept in a sidecar file, so that
+    # only added or changed alerts and tombstones of deleted ones need to be written
+    state_filename = f"{output_filename}.state"
+
+    state = None
+    if os.path.exists(output_filename) and os.path.exists(state_filename):
+        try:
+            with open(state_filename, 'r') as state_file:
+                state = json.loads(state_file.read())
+        except (OSError, ValueError) as ex:
+            logging.warning(f"could not read feed state {state_filename}: {ex}")
+
+    now = int(time.time())
+    digests = {alert_id: create_feed_digest(alert_entity) for alert_id, alert_entity in alerts.items()}
+
+    # a full snapshot is written periodically, so that new consumers can start from it
+    if state is None or now - state['snapshot'] >= snapshot_interval:
+        incrementality = 'FULL_DATASET'
+        changed_alerts = alerts
+        deleted_alert_ids = None
+        snapshot = now
+    else:
+        incrementality = 'DIFFERENTIAL'
+        changed_alerts = {alert_id: alert_entity for alert_id, alert_entity in alerts.items() if state['alerts'].get(alert_id) != digests[alert_id]}
+        deleted_alert_ids = [alert_id for alert_id in state['alerts'].keys() if alert_id not in alerts]
+        snapshot = state['snapshot']
+
+        if len(changed_alerts) == 0 and len(deleted_alert_ids) == 0:
+            return False
+
+    if output_filename.endswith('.json'):
+        content = json.dumps(create_feed_dict(changed_alerts, incrementality, deleted_alert_ids), indent=2, ensure_ascii=False).encode('utf-8')
+    elif output_filename.endswith('.pbf'):
+        content = create_feed_message(changed_alerts, incrementality, dict.fromkeys(deleted_alert_ids or [])).SerializeToString()
+    else:
+        logging.error(f"unknown output file type of {output_filename}")
+        return False
+
+    _write_atomically(output_filename, content)
+    _write_atomically(state_filename, json.dumps({'snapshot': snapshot, 'alerts': digests}).encode('utf-8'))
+
+    # the digest of the full output mode is outdated now
+    if os.path.exists(f"{output_filename}.etag"):
+        os.remove(f"{output_filename}.etag")
+
+    logging.info(f"{incrementality} feed with {len(changed_alerts)} alerts and {len(deleted_alert_ids or [])} deleted alerts written")
+
+    return True
+
+def _write_atomically(filename: str, content: bytes) -> None:
+    temporary_filename = f"{filename}.tmp"
+    with open(temporary_filename, 'wb') as temporary_file:
+        temporary_file.write(content)
+        temporary_file.flush()
+        os.fsync(temporary_file.fileno())
+
+    os.replace(temporary_filename, filename)
+
+def _fill_alert(alert: gtfs_realtime_pb2.Alert, alert_entity: dict) -> None:
+    alert.cause = gtfs_realtime_pb2.Alert.Cause.Value(alert_entity['cause'])
+    alert.effect = gtfs_realtime_pb2.Alert.Effect.Value(alert_entity['effect'])
+
+    for informed_entity in alert_entity['informed_entity']:
+        alert.informed_entity.add(**informed_entity)
+
+    for field in ['url', 'header_text', 'description_text']:
+        if field in alert_entity:
+
+            # translated strings are always present, even if they're empty
+            translated_string = getattr(alert, field)
+            translated_string.SetInParent()
+
+            for translation in alert_entity[field]['translation']:
+                translated_string.translation.add(language=translation['language'], text=translation['text'])
@@ -0,0 +1,96 @@
+import gzip
+import json
+import time
+
+from email.utils import formatdate, parsedate_to_datetime
+from http import HTTPStatus
+
+from . import feed
+from .httpserver import HttpRequest, HttpResponse
+
+
+class _FeedSnapshot:
+
+    def __init__(self, alerts: dict, digest: str):
+        self.last_modified = int(time.time())
+        self.last_modified_header = formatdate(self.last_modified, usegmt=True)
+
+        pbf = feed.create_feed_message(alerts).SerializeToString()
+        json_content = json.dumps(feed.create_feed_dict(alerts), ensure_ascii=False).encode('utf-8')
+
+        # every representation is serialized and compressed only once per change
+        # so that requests only need to pick the matching one
+        self.representations = {
+            ('pbf', False): (pbf, f"\"{digest[:32]}-pbf\""),
+            ('pbf', True): (gzip.compress(pbf, mtime=0), f"\"{digest[:32]}-pbf-gzip\""),
+            ('json', False): (json_content, f"\"{digest[:32]}-json\""),
+            ('json', True): (gzip.compress(json_content, mtime=0), f"\"{digest[:32]}-json-gzip\"")
+        }
+
+
+class FeedEndpoint:
+
+    content_types = {
+        'pbf': 'application/x-protobuf',
+        'json': 'application/json; charset=utf-8'
+    }
+
+    def __init__(self):
+        self._digest = None
+        self._snapshot = None
+
+    def update(self, alerts: dict) -> bool:
+
+        # the snapshot is only replaced if the alerts have changed,
+        # this way ETag and Last-Modified remain stable for polling clients
+        digest = feed.create_feed_digest(alerts)
+        if digest == self._digest:
+            return False
+
+        self._snapshot = _FeedSnapshot(alerts, digest)
+        self._digest = digest
+
+        return True
+
+    def handle(self, request: HttpRequest) -> HttpResponse:
+        snapshot = self._snapshot
+        if snapshot is None:
+            return HttpResponse(HTTPStatus.SERVICE_UNAVAILABLE, headers={'Retry-After': '10'})
+
+        format = request.query.get('format', 'pbf')
+        if format not in self.content_types:
+            return HttpResponse(HTTPStatus.BAD_REQUEST)
+
+        compressed = 'gzip' in request.headers.get('accept-encoding', '')
+        content, etag = snapshot.representations[(format, compressed)]
+
+        headers = {
+            'ETag': etag,
+            'Last-Modified': snapshot.last_modified_header,
+            'Cache-Control': 'no-cache',
+            'Vary': 'Accept-Encoding'
+        }
+
+        if self._is_not_modified(request, etag, snapshot.last_modified):
+            return HttpResponse(HTTPStatus.NOT_MODIFIED, headers=headers)
+
+        headers['Content-Type'] = self.content_types[format]
+        if compressed:
+            headers['Content-Encoding'] = 'gzip'
+
+        return HttpResponse(HTTPStatus.OK, content, headers)
+
+    def _is_not_modified(self, request: HttpRequest, etag: str, last_modified: int) -> bool:
+
+        # If-None-Match takes precedence over If-Modified-Since, see RFC 9110
+        if 'if-none-match' in request.headers:
+            etags = [e.strip() for e in request.headers['if-none-match'].split(',')]
+            return '*' in etags or etag in etags or f"W/{etag}" in etags
+
+        if 'if-modified-since' in request.headers:
+            try:
+                return last_modified <= int(parsedate_to_datetime(request.headers['if-modified-since']).timestamp())
+            except (TypeError, ValueError):
+                return False
+
+        return False
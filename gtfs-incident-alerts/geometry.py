@@ -0,0 +1,323 @@
+import mmap
+import numpy
+import os
+import shapely
+import tempfile
+
+from concurrent.futures import Executor
+from functools import cache
+from shapely import STRtree
+
+
+@cache
+def _transformer():
+
+    # pyproj and its CRS database are only loaded once coordinates need to be transformed
+    from pyproj import CRS, Transformer
+
+    return Transformer.from_crs(CRS('EPSG:4326'), CRS('EPSG:3857'), always_xy=True)
+
+def _transform_coordinates(coordinates: numpy.ndarray) -> numpy.ndarray:
+    x, y = _transformer().transform(coordinates[:, 0], coordinates[:, 1])
+    return numpy.column_stack((x, y))
+
+def project(geometries: list) -> numpy.ndarray:
+    return shapely.transform(numpy.asarray(geometries, dtype=object), _transform_coordinates)
+
+def create_pattern_set_shapes(pattern_set) -> numpy.ndarray:
+
+    # gather the points of all patterns from the flat coordinate array of the pattern set,
+    # patterns may share their points, e.g. if several routes run on the same shape
+    lengths = pattern_set.ends - pattern_set.starts
+    if lengths.sum() == 0:
+        return numpy.empty(0, dtype=object)
+
+    indices = numpy.repeat(numpy.arange(len(lengths)), lengths)
+    positions = numpy.arange(len(indices)) - numpy.repeat(numpy.cumsum(lengths) - lengths - pattern_set.starts, lengths)
+
+    coordinates = _transform_coordinates(pattern_set.coordinates[positions][:, ::-1])
+
+    return shapely.linestrings(coordinates, indices=indices)
+
+def merge_similar_shapes(shapes: numpy.ndarray, tolerance: float) -> tuple:
+    shapes = numpy.asarray(shapes, dtype=object)
+
+    # shapes within the tolerance of each other are considered to be the same,
+    # e.g. a short-turn variant or the opposite direction on the same street
+    shape_tree = STRtree(shapes)
+    first_indices, second_indices = shape_tree.query(shapes, predicate='dwithin', distance=tolerance)
+
+    candidates = first_indices < second_indices
+    first_indices, second_indices = first_indices[candidates], second_indices[candidates]
+
+    similar = shapely.hausdorff_distance(shapes[first_indices], shapes[second_indices]) <= tolerance
+    first_indices, second_indices = first_indices[similar], second_indices[similar]
+
+    # each shape is merged into the first similar one, which remains as it is,
+    # so that merged shapes never drift further than the tolerance apart
+    shape_map = numpy.arange(len(shapes))
+    for first_index, second_index in zip(first_indices.tolist(), second_indices.tolist()):
+        if shape_map[first_index] == first_index and shape_map[second_index] == second_index:
+            shape_map[second_index] = first_index
+
+    remaining = numpy.unique(shape_map)
+
+    return shapes[remaining], numpy.searchsorted(remaining, shape_map).astype(numpy.int32)
+
+def create_incident_shapes(coordinates: list) -> numpy.ndarray:
+    return project([shapely.LineString(c) for c in coordinates])
+
+def create_engine(pattern_shapes: list, segments: bool = False, buffer_size: float = 5.0, min_overlap: float = 40.0, simplify_tolerance: float = 0.0):
+    if segments:
+        return SegmentGeometryEngine(pattern_shapes, buffer_size, min_overlap, simplify_tolerance)
+    else:
+        return GeometryEngine(pattern_shapes, buffer_size, min_overlap)
+
+
+class GeometryEngine:
+
+    def __init__(self, pattern_shapes: list, buffer_size: float = 5.0, min_overlap: float = 40.0):
+        self._pattern_shapes = numpy.asarray(pattern_shapes, dtype=object)
+        self._pattern_tree = STRtree(self._pattern_shapes)
+
+        self._buffer_size = buffer_size
+        self._min_overlap = min_overlap
+
+        # number of candidate pairs tested by the last match
+        self.candidate_count = 0
+
+        # overlapping stretches are not determined by this engine
+        self.stretches = None
+
+    def match(self, incident_shapes: numpy.ndarray) -> list:
+
+        # Note: Intersection length should be a minimum of 40m with buffer size of 5m to avoid
+        # incident alerts for lines which are only crossing an incident, as they might not be affected.
+        # Be aware, that an intersection could happen in an angle of 90° (a normal crossing) but
+        # also can happen in an angle different than 90 degrees (e.g. a street located below or above another street).
+        # The buffer transforms the incident shape into a polygon which leads to a longer intersection at all!
+        incident_buffers = shapely.buffer(incident_shapes, self._buffer_size)
+        shapely.prepare(incident_buffers)
+
+        # find all candidate pairs at once and compute their intersection lengths vectorized
+        incident_indices, pattern_indices = self._pattern_tree.query(incident_buffers, predicate='intersects')
+        self.candidate_count = len(incident_indices)
+
+        intersections = shapely.intersection(self._pattern_shapes[pattern_indices], incident_buffers[incident_indices])
+        matching = shapely.length(intersections) >= self._min_overlap
+
+        incident_indices = incident_indices[matching]
+        pattern_indices = pattern_indices[matching]
+
+        # group matching patterns by incident, ordered by pattern index
+        order = numpy.lexsort((pattern_indices, incident_indices))
+        incident_indices = incident_indices[order]
+        pattern_indices = pattern_indices[order]
+
+        boundaries = numpy.searchsorted(incident_indices, numpy.arange(len(incident_shapes) + 1))
+
+        return [pattern_indices[boundaries[i]:boundaries[i + 1]] for i in range(len(incident_shapes))]
+
+    def close(self) -> None:
+        pass
+
+
+class SegmentGeometryEngine:
+
+    def __init__(self, pattern_shapes: list, buffer_size: float = 5.0, min_overlap: float = 40.0, simplify_tolerance: float = 0.0):
+        pattern_shapes = numpy.asarray(pattern_shapes, dtype=object)
+        if simplify_tolerance > 0:
+            pattern_shapes = shapely.simplify(pattern_shapes, simplify_tolerance)
+
+        # split all patterns into their segments, a segment connects
+        # two consecutive points of the same pattern
+        coordinates, point_patterns = shapely.get_coordinates(pattern_shapes, return_index=True)
+        connected = point_patterns[:-1] == point_patterns[1:]
+
+        self._segment_starts = coordinates[:-1][connected]
+        segment_ends = coordinates[1:][connected]
+
+        self._segment_patterns = point_patterns[:-1][connected]
+        self._segments = shapely.linestrings(numpy.stack((self._segment_starts, segment_ends), axis=1)) if len(self._segment_starts) > 0 else numpy.empty(0, dtype=object)
+        self._segment_tree = STRtree(self._segments)
+
+        # unit direction of each segment and the distance of its start along its pattern
+        segment_vectors = segment_ends - self._segment_starts
+        segment_lengths = numpy.hypot(segment_vectors[:, 0], segment_vectors[:, 1])
+
+        self._segment_directions = numpy.divide(segment_vectors, segment_lengths[:, None], out=numpy.zeros_like(segment_vectors), where=segment_lengths[:, None] > 0)
+
+        segment_measures = numpy.cumsum(segment_lengths) - segment_lengths
+        pattern_first_segments = numpy.searchsorted(self._segment_patterns, self._segment_patterns, side='left')
+        self._segment_measures = segment_measures - segment_measures[pattern_first_segments]
+
+        self._pattern_count = max(1, len(pattern_shapes))
+
+        self._buffer_size = buffer_size
+        self._min_overlap = min_overlap
+
+        self.candidate_count = 0
+        self.stretches = None
+
+    def match(self, incident_shapes: numpy.ndarray) -> list:
+
+        # the same rule as for whole patterns applies, but the overlap is only computed
+        # for the segments near an incident and summed up for each pattern
+        incident_buffers = shapely.buffer(incident_shapes, self._buffer_size)
+        shapely.prepare(incident_buffers)
+
+        incident_indices, segment_indices = self._segment_tree.query(incident_buffers, predicate='intersects')
+        self.candidate_count = len(incident_indices)
+
+        pieces = shapely.intersection(self._segments[segment_indices], incident_buffers[incident_indices])
+        piece_lengths = shapely.length(pieces)
+
+        # locate the ends of each overlapping piece along its pattern
+        piece_coordinates, piece_indices = shapely.get_coordinates(pieces, return_index=True)
+        piece_segments = segment_indices[piece_indices]
+        piece_coordinate_measures = self._segment_measures[piece_segments] + numpy.einsum('ij,ij->i', piece_coordinates - self._segment_starts[piece_segments], self._segment_directions[piece_segments])
+
+        piece_starts = numpy.full(len(pieces), numpy.inf)
+        piece_ends = numpy.full(len(pieces), -numpy.inf)
+        numpy.minimum.at(piece_starts, piece_indices, piece_coordinate_measures)
+        numpy.maximum.at(piece_ends, piece_indices, piece_coordinate_measures)
+
+        # group pieces by incident and pattern, ordered by incident and pattern index
+        pair_keys = incident_indices.astype(numpy.int64) * self._pattern_count + self._segment_patterns[segment_indices]
+        pair_keys, pair_indices = numpy.unique(pair_keys, return_inverse=True)
+
+        pair_lengths = numpy.bincount(pair_indices, weights=piece_lengths, minlength=len(pair_keys))
+
+        # pieces of a pattern running back over the same street overlap each other, so they're
+        # merged before the overlap is checked, like the intersection with a whole pattern does,
+        # only pairs with a sum of pieces long enough can match at all
+        candidate_pairs = numpy.flatnonzero(pair_lengths >= self._min_overlap)
+        if len(candidate_pairs) > 0:
+            pair_lengths[candidate_pairs] = self._merge_pieces(pieces, pair_indices, candidate_pairs)
+
+        overlapping = piece_lengths > 0
+        pair_starts = numpy.full(len(pair_keys), numpy.inf)
+        pair_ends = numpy.full(len(pair_keys), -numpy.inf)
+        numpy.minimum.at(pair_starts, pair_indices[overlapping], piece_starts[overlapping])
+        numpy.maximum.at(pair_ends, pair_indices[overlapping], piece_ends[overlapping])
+
+        matching = pair_lengths >= self._min_overlap
+
+        pair_keys = pair_keys[matching]
+        pair_stretches = numpy.column_stack((pair_starts[matching], pair_ends[matching], pair_lengths[matching]))
+
+        incident_indices = pair_keys // self._pattern_count
+        pattern_indices = pair_keys % self._pattern_count
+
+        boundaries = numpy.searchsorted(incident_indices, numpy.arange(len(incident_shapes) + 1))
+
+        self.stretches = [pair_stretches[boundaries[i]:boundaries[i + 1]] for i in range(len(incident_shapes))]
+
+        return [pattern_indices[boundaries[i]:boundaries[i + 1]] for i in range(len(incident_shapes))]
+
+    def close(self) -> None:
+        pass
+
+    def _merge_pieces(self, pieces: numpy.ndarray, pair_indices: numpy.ndarray, candidate_pairs: numpy.ndarray) -> numpy.ndarray:
+        candidates = numpy.isin(pair_indices, candidate_pairs)
+
+        order = numpy.argsort(pair_indices[candidates], kind='stable')
+        candidate_pieces = pieces[candidates][order]
+        rows = numpy.searchsorted(candidate_pairs, pair_indices[candidates][order])
+
+        # arrange the pieces of each pair in one row, padded with missing geometries,
+        # so that they can be merged for all pairs at once
+        counts = numpy.bincount(rows, minlength=len(candidate_pairs))
+        columns = numpy.arange(len(rows)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+
+        pair_pieces = numpy.full((len(candidate_pairs), counts.max()), None, dtype=object)
+        pair_pieces[rows, columns] = candidate_pieces
+
+        return shapely.length(shapely.union_all(pair_pieces, axis=1))
+
+
+class ParallelGeometryEngine:
+
+    def __init__(self, pattern_shapes: list, executor: Executor, workers: int, **engine_options):
+        self._executor = executor
+        self._workers = workers
+
+        self._engine_options = engine_options
+
+        self.candidate_count = 0
+        self.stretches = None
+
+        # share pattern shapes with all workers as memory-mapped WKB file
+        # workers build their engine only once for each pattern set
+        with tempfile.NamedTemporaryFile(prefix='gtfs-incident-alerts-', suffix='.wkb', delete=False) as shapes_file:
+            _write_shapes(shapes_file, pattern_shapes)
+
+            self._shapes_filename = shapes_file.name
+
+    def match(self, incident_shapes: numpy.ndarray) -> list:
+        self.candidate_count = 0
+        self.stretches = None
+        if len(incident_shapes) == 0:
+            return list()
+
+        # split incidents into chunks and match them in parallel,
+        # results are merged in order of the chunks
+        chunk_size = max(1, -(-len(incident_shapes) // (self._workers * 2)))
+        chunks = [shapely.to_wkb(incident_shapes[i:i + chunk_size]).tolist() for i in range(0, len(incident_shapes), chunk_size)]
+
+        results = list()
+        stretches = list()
+        for chunk_result, chunk_candidate_count, chunk_stretches in self._executor.map(_match_chunk, [self._shapes_filename] * len(chunks), chunks, [self._engine_options] * len(chunks)):
+            results.extend(chunk_result)
+            self.candidate_count = self.candidate_count + chunk_candidate_count
+
+            if chunk_stretches is not None:
+                stretches.extend(chunk_stretches)
+
+        if len(stretches) == len(results):
+            self.stretches = stretches
+
+        return results
+
+    def close(self) -> None:
+
+        # workers drop their engine of this pattern set once its file is removed
+        if os.path.exists(self._shapes_filename):
+            os.remove(self._shapes_filename)
+
+
+_worker_engines = dict()
+
+def _match_chunk(shapes_filename: str, incident_wkb: list, engine_options: dict) -> tuple:
+
+    # workers are shared by all pattern providers, so they keep one engine for each
+    # live shapes file, engines of files removed by closing their engine are dropped
+    for outdated_key in [k for k in _worker_engines.keys() if not os.path.exists(k[0])]:
+        del _worker_engines[outdated_key]
+
+    engine_key = (shapes_filename, tuple(sorted(engine_options.items())))
+    if engine_key not in _worker_engines:
+        _worker_engines[engine_key] = create_engine(_read_shapes(shapes_filename), **engine_options)
+
+    engine = _worker_engines[engine_key]
+    return engine.match(shapely.from_wkb(incident_wkb)), engine.candidate_count, engine.stretches
+
+def _write_shapes(shapes_file, pattern_shapes: list) -> None:
+    wkb_shapes = shapely.to_wkb(numpy.asarray(pattern_shapes, dtype=object)).tolist()
+
+    offsets = numpy.zeros(len(wkb_shapes) + 1, dtype='<i8')
+    offsets[1:] = numpy.cumsum([len(s) for s in wkb_shapes])
+
+    shapes_file.write(len(wkb_shapes).to_bytes(8, byteorder='little', signed=True))
+    shapes_file.write(offsets.tobytes())
+    shapes_file.write(b''.join(wkb_shapes))
+
+def _read_shapes(shapes_filename: str) -> numpy.ndarray:
+    with open(shapes_filename, 'rb') as shapes_file:
+        with mmap.mmap(shapes_file.fileno(), 0, access=mmap.ACCESS_READ) as shapes_buffer:
+            count = int.from_bytes(shapes_buffer[0:8], byteorder='little', signed=True)
+            offsets = numpy.frombuffer(shapes_buffer[8:8 * (count + 2)], dtype='<i8')
+
+            data_offset = 8 * (count + 2)
+
+            return shapely.from_wkb([shapes_buffer[data_offset + offsets[i]:data_offset + offsets[i + 1]] for i in range(count)])
@@ -0,0 +1,305 @@
+import csv
+import glob
+import hashlib
+import io
+import json
+import logging
+import mmap
+import numpy
+import os
+import struct
+import zipfile
+
+from appdirs import site_data_dir
+from array import array
+from datetime import datetime
+
+from .model import PatternSet, Route
+from .version import version
+
+
+class GtfsReader:
+
+    _magic = b'GIAGI1'
+
+    # route types and their extended counterparts mapped to OTP transit modes
+    _route_modes = {
+        0: 'TRAM', 1: 'SUBWAY', 2: 'RAIL', 3: 'BUS', 4: 'FERRY', 5: 'CABLE_CAR', 6: 'GONDOLA', 7: 'FUNICULAR', 11: 'TROLLEYBUS', 12: 'MONORAIL',
+        100: 'RAIL', 200: 'COACH', 400: 'SUBWAY', 700: 'BUS', 800: 'TROLLEYBUS', 900: 'TRAM', 1000: 'FERRY', 1200: 'FERRY', 1300: 'GONDOLA', 1400: 'FUNICULAR', 1500: 'TAXI'
+    }
+
+    def __init__(self, gtfs_filename: str, cache_dir: str = None):
+        if cache_dir is None:
+            cache_dir = site_data_dir(appname='gtfs-incident-alerts', appauthor='skc', version=version)
+
+        self._gtfs_filename = os.path.abspath(gtfs_filename)
+        self._cache_dir = cache_dir
+
+        self._path_key = hashlib.sha1(self._gtfs_filename.encode('utf-8')).hexdigest()[:16]
+        self._file_key = self._create_file_key()
+
+        self.source_key = f"{self._gtfs_filename}:{self._file_key}"
+
+        self._index_file = None
+        self._index_buffer = None
+        self._header = None
+        self._routes = None
+        self._offsets = None
+        self._coordinates = None
+
+    def load_active_pattern(self, date: str, deadline: float = None) -> PatternSet:
+
+        # the index is only valid as long as the GTFS file remains the same
+        file_key = self._create_file_key()
+        if file_key != self._file_key:
+            self.close()
+
+            self._file_key = file_key
+            self.source_key = f"{self._gtfs_filename}:{self._file_key}"
+
+        if self._header is None:
+            self._load_index()
+
+            self._routes = [Route.from_dict(route) for route in self._header['routes']]
+
+        service_date = int(date.replace('-', ''))
+        weekday = 1 << datetime.strptime(date, '%Y-%m-%d').weekday()
+
+        # determine all services operating on this date
+        active_services = set()
+        for service, start_date, end_date, weekdays in self._header['calendar']:
+            if start_date <= service_date <= end_date and weekdays & weekday:
+                active_services.add(service)
+
+        for service, exception_type in self._header['calendar_dates'].get(str(service_date), []):
+            if exception_type == 1:
+                active_services.add(service)
+            elif exception_type == 2:
+                active_services.discard(service)
+
+        route_indices = list()
+        shape_indices = list()
+        for route_index, shape_index, services in self._header['patterns']:
+            if active_services.isdisjoint(services):
+                continue
+
+            route_indices.append(route_index)
+            shape_indices.append(shape_index)
+
+        # shapes are referenced within the memory-mapped index, each one is a geometry
+        used_shapes, geometry_indices = numpy.unique(numpy.array(shape_indices, dtype=numpy.int64), return_inverse=True)
+
+        return PatternSet(
+            self._routes,
+            numpy.array(route_indices, dtype=numpy.int32),
+            geometry_indices.reshape(-1).astype(numpy.int32),
+            self._offsets[used_shapes],
+            self._offsets[used_shapes + 1],
+            self._coordinates
+        )
+
+    def close(self) -> None:
+        self._routes = None
+        self._offsets = None
+        self._coordinates = None
+        self._header = None
+
+        if self._index_buffer is not None:
+            try:
+                self._index_buffer.close()
+            except BufferError:
+                # shapes of the last load are still referenced, the mapping is closed along with them
+                pass
+
+            self._index_buffer = None
+
+        if self._index_file is not None:
+            self._index_file.close()
+            self._index_file = None
+
+    def _create_file_key(self) -> str:
+        gtfs_stat = os.stat(self._gtfs_filename)
+        return hashlib.sha1(f"{gtfs_stat.st_size}:{gtfs_stat.st_mtime_ns}".encode('utf-8')).hexdigest()[:16]
+
+    def _load_index(self) -> None:
+        index_filename = os.path.join(self._cache_dir, f"gtfs-{self._path_key}-{self._file_key}.index")
+
+        if os.path.exists(index_filename):
+            try:
+                self._open_index(index_filename)
+                logging.info(f"GTFS Reader: Loaded index {index_filename}")
+
+                return
+            except (OSError, ValueError, KeyError) as ex:
+                logging.warning(f"GTFS Reader: Could not read index {index_filename}: {ex}")
+                self.close()
+
+        header, offsets, coordinates = self._build_index()
+
+        try:
+            self._write_index(index_filename, header, offsets, coordinates)
+            self._open_index(index_filename)
+
+            logging.info(f"GTFS Reader: Stored index in {index_filename}")
+        except OSError as ex:
+            logging.warning(f"GTFS Reader: Could not write index: {ex}")
+
+            self._header = header
+            self._offsets = offsets
+            self._coordinates = coordinates
+
+    def _open_index(self, index_filename: str) -> None:
+        self._index_file = open(index_filename, 'rb')
+        self._index_buffer = mmap.mmap(self._index_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._index_buffer[0:len(self._magic)] != self._magic:
+            raise ValueError('invalid file signature')
+
+        header_length, = struct.unpack('<I', self._index_buffer[len(self._magic):len(self._magic) + 4])
+        data_offset = len(self._magic) + 4 + header_length
+
+        header = json.loads(self._index_buffer[len(self._magic) + 4:data_offset])
+        header['patterns'] = [(r, s, frozenset(services)) for r, s, services in header['patterns']]
+
+        self._offsets = numpy.frombuffer(self._index_buffer, dtype='<i8', count=header['shapes'] + 1, offset=data_offset)
+        self._coordinates = numpy.frombuffer(self._index_buffer, dtype='<f8', count=header['points'] * 2, offset=data_offset + 8 * (header['shapes'] + 1)).reshape(-1, 2)
+        self._header = header
+
+    def _write_index(self, index_filename: str, header: dict, offsets: numpy.ndarray, coordinates: numpy.ndarray) -> None:
+        header = dict(header)
+        header['patterns'] = [(r, s, sorted(services)) for r, s, services in header['patterns']]
+
+        # pad the header, so that the arrays are aligned to 8 bytes
+        header_bytes = json.dumps(header).encode('utf-8')
+        header_bytes = header_bytes + b' ' * (-(len(self._magic) + 4 + len(header_bytes)) % 8)
+
+        if not os.path.exists(self._cache_dir):
+            os.makedirs(self._cache_dir)
+
+        with open(f"{index_filename}.tmp", 'wb') as index_file:
+            index_file.write(self._magic)
+            index_file.write(struct.pack('<I', len(header_bytes)))
+            index_file.write(header_bytes)
+            index_file.write(offsets.astype('<i8').tobytes())
+            index_file.write(coordinates.astype('<f8').tobytes())
+
+        os.replace(f"{index_filename}.tmp", index_filename)
+
+        # remove indices of previous versions of this GTFS file
+        for outdated_filename in glob.glob(os.path.join(self._cache_dir, f"gtfs-{self._path_key}-*.index")):
+            if outdated_filename != index_filename:
+                os.remove(outdated_filename)
+
+    def _build_index(self) -> tuple:
+        logging.info(f"GTFS Reader: Building index of {self._gtfs_filename} ...")
+
+        with zipfile.ZipFile(self._gtfs_filename) as gtfs_zip:
+            routes = list()
+            route_indices = dict()
+            for row in self._read_csv(gtfs_zip, 'routes.txt', ['route_id', 'route_short_name', 'route_long_name', 'route_type']):
+                route_id, short_name, long_name, route_type = row
+
+                route_type = int(route_type)
+                route_indices[route_id] = len(routes)
+                routes.append({
+                    'gtfsId': route_id,
+                    'shortName': short_name or '',
+                    'longName': long_name or '',
+                    'mode': self._route_modes.get(route_type, self._route_modes.get(route_type // 100 * 100, 'BUS')),
+                    'type': route_type
+                })
+
+            # a pattern is a distinct combination of route and shape,
+            # it is active if at least one of its services operates
+            services = dict()
+            shape_indices = dict()
+            patterns = dict()
+            for row in self._read_csv(gtfs_zip, 'trips.txt', ['route_id', 'service_id', 'shape_id']):
+                route_id, service_id, shape_id = row
+                if not shape_id or route_id not in route_indices:
+                    continue
+
+                shape_index = shape_indices.setdefault(shape_id, len(shape_indices))
+                service_index = services.setdefault(service_id, len(services))
+
+                patterns.setdefault((route_indices[route_id], shape_index), set()).add(service_index)
+
+            calendar = list()
+            for row in self._read_csv(gtfs_zip, 'calendar.txt', ['service_id', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday', 'start_date', 'end_date']):
+                if row[0] not in services:
+                    continue
+
+                weekdays = sum(1 << i for i, flag in enumerate(row[1:8]) if flag == '1')
+                calendar.append((services[row[0]], int(row[8]), int(row[9]), weekdays))
+
+            calendar_dates = dict()
+            for row in self._read_csv(gtfs_zip, 'calendar_dates.txt', ['service_id', 'date', 'exception_type']):
+                if row[0] not in services:
+                    continue
+
+                calendar_dates.setdefault(row[1], list()).append((services[row[0]], int(row[2])))
+
+            # shape points are collected in flat arrays and ordered by shape and sequence afterwards,
+            # since shapes.txt does not need to be sorted
+            point_shapes = array('q')
+            point_sequences = array('q')
+            point_coordinates = array('d')
+            for row in self._read_csv(gtfs_zip, 'shapes.txt', ['shape_id', 'shape_pt_sequence', 'shape_pt_lat', 'shape_pt_lon']):
+                shape_index = shape_indices.get(row[0])
+                if shape_index is None:
+                    continue
+
+                point_shapes.append(shape_index)
+                point_sequences.append(int(row[1]))
+                point_coordinates.append(float(row[2]))
+                point_coordinates.append(float(row[3]))
+
+        point_shapes = numpy.array(point_shapes, dtype=numpy.int64)
+        point_sequences = numpy.array(point_sequences, dtype=numpy.int64)
+        coordinates = numpy.array(point_coordinates, dtype=float).reshape(-1, 2)
+
+        order = numpy.lexsort((point_sequences, point_shapes))
+        coordinates = coordinates[order]
+
+        offsets = numpy.zeros(len(shape_indices) + 1, dtype='<i8')
+        offsets[1:] = numpy.cumsum(numpy.bincount(point_shapes, minlength=len(shape_indices)))
+
+        # patterns without a usable shape cannot be matched
+        pattern_list = list()
+        for (route_index, shape_index), pattern_services in sorted(patterns.items()):
+            if offsets[shape_index + 1] - offsets[shape_index] >= 2:
+                pattern_list.append((route_index, shape_index, frozenset(pattern_services)))
+
+        logging.info(f"GTFS Reader: Found {len(pattern_list)} patterns of {len(routes)} routes with {len(coordinates)} shape points")
+
+        header = {
+            'routes': routes,
+            'calendar': calendar,
+            'calendar_dates': calendar_dates,
+            'patterns': pattern_list,
+            'shapes': len(shape_indices),
+            'points': len(coordinates)
+        }
+
+        return header, offsets, coordinates
+
+    def _read_csv(self, gtfs_zip: zipfile.ZipFile, filename: str, columns: list):
+
+        # calendar.txt and calendar_dates.txt are optional as long as one of them exists
+        if filename not in gtfs_zip.namelist():
+            if filename in ['calendar.txt', 'calendar_dates.txt']:
+                return
+
+            raise ValueError(f"GTFS file {self._gtfs_filename} does not contain {filename}")
+
+        with gtfs_zip.open(filename) as csv_file:
+            reader = csv.reader(io.TextIOWrapper(csv_file, encoding='utf-8-sig', newline=''))
+
+            header = [c.strip() for c in next(reader, [])]
+            indices = [header.index(c) if c in header else None for c in columns]
+
+            for row in reader:
+                if len(row) == 0:
+                    continue
+
+                yield [row[i].strip() if i is not None and i < len(row) else '' for i in indices]
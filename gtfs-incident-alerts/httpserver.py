@@ -0,0 +1,136 @@
+import asyncio
+import logging
+
+from email.utils import formatdate
+from http import HTTPStatus
+from urllib.parse import parse_qs, urlsplit
+
+
+class HttpRequest:
+
+    def __init__(self, method: str, target: str, headers: dict):
+        target = urlsplit(target)
+
+        self.method = method
+        self.path = target.path
+        self.query = {k: v[-1] for k, v in parse_qs(target.query).items()}
+        self.headers = headers
+
+
+class HttpResponse:
+
+    def __init__(self, status: int = 200, body: bytes = b'', headers: dict = None):
+        self.status = status
+        self.body = body
+        self.headers = headers if headers is not None else dict()
+
+
+class HttpServer:
+
+    def __init__(self, address: str, idle_timeout: float = 30.0):
+        host, port = address.rsplit(':', 1)
+
+        self._host = host if host != '' else '0.0.0.0'
+        self._port = int(port)
+
+        # idle or half-open connections are closed after this timeout,
+        # so that they don't pile up with many polling clients
+        self._idle_timeout = idle_timeout
+
+        self._routes = dict()
+        self._server = None
+
+    def route(self, path: str, handler) -> None:
+        self._routes[path] = handler
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle_connection, self._host, self._port)
+        logging.info(f"HTTP server listening on {self._host}:{self._port}")
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+            self._server = None
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            keep_alive = True
+            while keep_alive:
+                request = await asyncio.wait_for(self._read_request(reader), timeout=self._idle_timeout)
+                if request is None:
+                    break
+
+                method, target, version, headers = request
+
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+
+                response = self._handle_request(HttpRequest(method, target, headers))
+                self._write_response(writer, method, response, keep_alive)
+
+                await asyncio.wait_for(writer.drain(), timeout=self._idle_timeout)
+        except (ValueError, ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> tuple | None:
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+
+        method, target, version = request_line.decode('latin-1').strip().split(' ', 2)
+
+        headers = dict()
+        while True:
+            header_line = await reader.readline()
+            if header_line in (b'\r\n', b'\n', b''):
+                break
+
+            name, value = header_line.decode('latin-1').split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+
+        if 'content-length' in headers:
+            await reader.readexactly(int(headers['content-length']))
+
+        return method, target, version, headers
+
+    def _handle_request(self, request: HttpRequest) -> HttpResponse:
+        if request.method not in ['GET', 'HEAD']:
+            return HttpResponse(HTTPStatus.METHOD_NOT_ALLOWED)
+
+        handler = self._routes.get(request.path)
+        if handler is None:
+            return HttpResponse(HTTPStatus.NOT_FOUND)
+
+        try:
+            return handler(request)
+        except Exception as ex:
+            logging.exception(ex)
+            return HttpResponse(HTTPStatus.INTERNAL_SERVER_ERROR)
+
+    def _write_response(self, writer: asyncio.StreamWriter, method: str, response: HttpResponse, keep_alive: bool) -> None:
+        status = HTTPStatus(response.status)
+
+        headers = {
+            'Date': formatdate(usegmt=True),
+            'Connection': 'keep-alive' if keep_alive else 'close'
+        }
+
+        if keep_alive:
+            headers['Keep-Alive'] = f"timeout={int(self._idle_timeout)}"
+
+        # responses without content must not announce any length
+        if status != HTTPStatus.NOT_MODIFIED:
+            headers['Content-Length'] = str(len(response.body))
+
+        headers.update(response.headers)
+
+        head = f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+        head = head + ''.join(f"{name}: {value}\r\n" for name, value in headers.items())
+        head = head + '\r\n'
+
+        writer.write(head.encode('latin-1'))
+        if method != 'HEAD' and status != HTTPStatus.NOT_MODIFIED:
+            writer.write(response.body)
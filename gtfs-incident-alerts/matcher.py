@@ -1,34 +1,69 @@
+import hashlib
 import json
 import logging
-import polyline
 import os
 import re
 import time
 import uuid
-import yaml
 
+from collections import OrderedDict
 from datetime import datetime
-from google.transit import gtfs_realtime_pb2
-from google.protobuf.json_format import ParseDict
-from mako.template import Template
-from shapely import LineString
-from shapely.ops import transform
-from pyproj import CRS, Transformer
 from urllib.parse import urlparse
 
-from .mqtt import GtfsRealtimeServiceAlertPublisher
-from .otpclient import OtpClient
+from . import geometry
+
+from .metrics import metrics
+from .model import PatternSet, Route
+from .resources import SharedResources
+from .templates import ServiceAlertTemplate
 
 class OtpGtfsMatcher:
 
-    def __init__(self, otp_url: str, template_filename: str):
-        self._otp_client = OtpClient(otp_url)
-        
-        with open(template_filename, 'r', encoding='utf-8') as template_file:
-            templates = yaml.safe_load(template_file)
-            self._templates = templates['templates']
+    def __init__(self, otp_url: str, template_filename: str, pattern_cache: bool = True, incremental: bool = False, workers: int = 1, gtfs_filename: str = None, text_cache_size: int = 4096, segments: bool = False, simplify_tolerance: float = 0.0, buffer_size: float = 5.0, min_overlap: float = 40.0, merge_tolerance: float = 0.0, differential: bool = False, snapshot_interval: int = 3600, interval: float = None, resources: SharedResources = None):
+
+        # patterns, templates and broker connections may be shared with other matchers,
+        # a matcher on its own has resources of its own
+        self._resources = resources if resources is not None else SharedResources(pattern_cache, workers)
+        self._owns_resources = resources is None
+
+        self._patterns = self._resources.get_pattern_provider(
+            otp_url,
+            gtfs_filename,
+            segments=segments,
+            buffer_size=buffer_size,
+            min_overlap=min_overlap,
+            simplify_tolerance=simplify_tolerance,
+            merge_tolerance=merge_tolerance
+        )
+
+        # retained messages are refreshed depending on the interval
+        # of the cycles calling the matcher, if it is called repeatedly
+        self._mqtt_publisher = None
+        self._interval = interval
+
+        self._incremental = incremental
+        self._incremental_key = None
+        self._incremental_results = dict()
+
+        self._alert_fingerprints = dict()
+
+        # output files may contain only the changes since the previous cycle
+        self._differential = differential
+        self._snapshot_interval = snapshot_interval
 
-    def match(self, input_filename, output_filename, mqtt_uri, mqtt_expiration):
+        # rendered texts are kept across cycles, as most alerts remain the same
+        self._text_cache = OrderedDict()
+        self._text_cache_size = text_cache_size
+        self._text_cache_hits = 0
+        self._text_cache_misses = 0
+
+        self._template_set = self._resources.get_template_set(template_filename)
+        self._templates = None
+        self._templates_hash = None
+
+        self._load_templates()
+
+    def match(self, input_filename, output_filename, mqtt_uri, mqtt_expiration, deadline: float = None) -> dict | None:
         
         # load incident input GeoJSON file
         # if it is no file, use the input as GeoJSON directly
@@ -38,161 +73,255 @@ class OtpGtfsMatcher:
         else:
             geojson = input_filename
 
+        # reload templates if they have been changed meanwhile
+        self._load_templates()
+
         # load active patterns for the current operation day
-        otp_patterns = self._otp_client.load_active_pattern(
-            datetime.now().strftime('%Y-%m-%d')
-        )
+        with metrics.stage('patterns'):
+            patterns, pattern_key = self._load_patterns(datetime.now().strftime('%Y-%m-%d'), deadline)
 
         # debugging output
-        logging.info(f"found {len(geojson['features'])} raw incidents total")
-        logging.info(f"found {len(otp_patterns)} trip patterns total")
+        logging.info(f"found {len(patterns)} trip patterns total")
+
+        metrics.count('patterns', len(patterns))
 
-        # iterate through all incidents found
+        # in incremental mode, results of the previous cycle are reused for unchanged incidents
+        # they're only valid as long as the patterns and templates remain the same
+        if self._incremental:
+            incremental_key = (pattern_key, self._templates_hash)
+            if incremental_key != self._incremental_key:
+                self._incremental_key = incremental_key
+                self._incremental_results = dict()
+
+        # select all incidents which might be relevant and match them
+        # against the pattern shapes in one batch, incidents may also be
+        # streamed from their source, so only the relevant ones are kept
+        incident_results = list()
+        incidents = list()
+        with metrics.stage('select'):
+            for incident in geojson['features']:
+                fingerprint = self._create_fingerprint(incident) if self._incremental else None
+                if fingerprint in self._incremental_results:
+                    incident_results.append((fingerprint, self._incremental_results[fingerprint]))
+                    continue
+
+                incident_results.append((fingerprint, None))
+
+                template = self._templates.find_template(incident)
+                if template is not None and incident['geometry']['type'] == 'LineString':
+                    incidents.append((len(incident_results) - 1, incident, template))
+
+        logging.info(f"found {len(incident_results)} raw incidents total")
+        metrics.count('incidents', len(incident_results))
+
+        if self._incremental:
+            logging.info(f"found {len(incident_results) - len(incidents)} unchanged or irrelevant incidents")
+
+        with metrics.stage('geometry'):
+            incident_shapes = geometry.create_incident_shapes([incident['geometry']['coordinates'] for _, incident, _ in incidents])
+            patterns, incident_matches, candidate_count, incident_stretches = self._patterns.match(incident_shapes)
+
+        metrics.count('matched_incidents', len(incidents))
+        metrics.count('candidate_pairs', candidate_count)
+
+        with metrics.stage('render'):
+            self._create_service_alerts(patterns, incident_results, incidents, incident_matches, incident_stretches)
+
+        metrics.count('rendered_texts', self._text_cache_misses)
+        metrics.count('cached_texts', self._text_cache_hits)
+
+        # collect alerts of all incidents in their original order
         alerts = dict()
-        for incident in geojson['features']:
-            if self._any_template_available(incident):
-
-                if incident['geometry']['type'] == 'LineString':
-                    incident_shape = LineString(incident['geometry']['coordinates'])
- 
-                incident_shape = transform(Transformer.from_crs(CRS('EPSG:4326'), CRS('EPSG:3857'), always_xy=True).transform, incident_shape)
-
-                # check for patterns matching this incident
-                affected_routes = dict()
-                for pattern in otp_patterns:
-                    if self._test_pattern_match(pattern, incident_shape):
-                        if pattern['route']['gtfsId'] not in affected_routes.keys():
-                            affected_routes[pattern['route']['gtfsId']] = pattern['route']
-
-                # if there's at least one line affected ...
-                if len(affected_routes) > 0:
-                    for template in self._templates:
-                        if self._template_available(template, incident):
-                            template_data = {
-                                'startLocationName': incident['properties']['from'],
-                                'endLocationName': incident['properties']['to'],
-                                'affectedLines': self._natural_sort(list(affected_routes.values()), 'shortName')
-                            }
-                            
-                            alert_id, alert_entity = self._create_service_alert(template, incident, **template_data)
-                            alerts[alert_id] = alert_entity
-
-                            # first template has matched
-                            # do not create multiple alerts
-                            # for the same incident
-                            break
+        for _, incident_result in incident_results:
+            if incident_result is not None:
+                alert_id, alert_entity = incident_result
+                alerts[alert_id] = alert_entity
+
+        if self._incremental:
+            self._incremental_results = dict(incident_results)
+
+        self._count_alert_changes(alerts)
 
         # create desired output
         logging.info(f"found {len(alerts)} matching incidents total")
-        if mqtt_uri is not None:
-            logging.info("publishing to MQTT ...")
 
-            mqtt_uri = urlparse(mqtt_uri)
+        # outdated alerts must not replace those of a later cycle
+        if deadline is not None and time.monotonic() > deadline:
+            logging.error('cycle deadline exceeded after matching incidents, skipping output')
+            return None
+        with metrics.stage('output'):
+            self._write_output(alerts, output_filename, mqtt_uri, mqtt_expiration)
+
+        return alerts
+
+    def load_patterns(self, deadline: float = None) -> None:
+
+        # called once per cycle of the daemon, loaded patterns are revalidated
+        # against their source from time to time
+        self._patterns.load(datetime.now().strftime('%Y-%m-%d'), deadline, True)
+
+    def close(self) -> None:
+        if self._mqtt_publisher is not None:
+            self._mqtt_publisher.stop()
+            self._mqtt_publisher = None
+
+        if self._owns_resources:
+            self._resources.close()
+
+    def _create_mqtt_publisher(self, mqtt_uri: str, mqtt_expiration: int):
+        from .mqtt import GtfsRealtimeServiceAlertPublisher
+
+        mqtt_uri = urlparse(mqtt_uri)
+
+        mqtt_params = mqtt_uri.netloc.split('@')
+        mqtt_topic = mqtt_uri.path
+
+        if len(mqtt_params) == 1:
+            mqtt_username, mqtt_password = None, None
+            mqtt_host, mqtt_port = mqtt_params[0].split(':')
+        elif len(mqtt_params) == 2:
+            mqtt_username, mqtt_password = mqtt_params[0].split(':')
+            mqtt_host, mqtt_port = mqtt_params[1].split(':')
+
+        mqtt_connection = self._resources.get_mqtt_connection(mqtt_host, mqtt_port, mqtt_username, mqtt_password)
+
+        return GtfsRealtimeServiceAlertPublisher(host=mqtt_host, port=mqtt_port, username=mqtt_username, password=mqtt_password, topic=mqtt_topic, expiration=mqtt_expiration, connection=mqtt_connection, interval=self._interval)
+
+    def _load_patterns(self, date: str, deadline: float = None) -> tuple:
+
+        # patterns are loaded only once per operation day
+        # and shared with all matchers using the same source
+        return self._patterns.load(date, deadline)
+
+    def _load_templates(self) -> None:
+        templates, templates_hash = self._template_set.reload()
+        if templates_hash == self._templates_hash:
+            return
+
+        self._templates = templates
+        self._templates_hash = templates_hash
+
+        # rendered texts of the previous templates are invalid now
+        self._text_cache.clear()
+
+    def _create_service_alerts(self, patterns: PatternSet, incident_results: list, incidents: list, incident_matches: list, incident_stretches: list = None) -> None:
+        self._text_cache_hits = 0
+        self._text_cache_misses = 0
+
+        for match_index, ((result_index, incident, template), pattern_indices) in enumerate(zip(incidents, incident_matches)):
+
+            # collect routes of all patterns matching this incident
+            affected_routes = dict()
+            for pattern_index in pattern_indices:
+                route = patterns.route(pattern_index)
+                if route.gtfsId not in affected_routes:
+                    affected_routes[route.gtfsId] = route
+
+            # if there's at least one line affected ...
+            # create an alert with the first matching template
+            if len(affected_routes) > 0:
+                template_data = {
+                    'startLocationName': incident['properties']['from'],
+                    'endLocationName': incident['properties']['to'],
+                    'affectedLines': self._natural_sort(list(affected_routes.values()), 'shortName')
+                }
+
+                # overlapping stretches along each pattern are only available with some engines
+                if incident_stretches is not None:
+                    template_data['affectedStretches'] = self._create_stretches(patterns, pattern_indices, incident_stretches[match_index])
+                
+                fingerprint, _ = incident_results[result_index]
+                incident_results[result_index] = (fingerprint, self._create_service_alert(template, incident, **template_data))
+
+    def _create_stretches(self, patterns: PatternSet, pattern_indices: list, stretches: list) -> list:
+        result = list()
+        for pattern_index, (start, end, length) in zip(pattern_indices, stretches):
+            route = patterns.route(pattern_index)
+            result.append({
+                'gtfsId': route.gtfsId,
+                'shortName': route.shortName,
+                'start': round(float(start)),
+                'end': round(float(end)),
+                'length': round(float(length))
+            })
 
-            mqtt_params = mqtt_uri.netloc.split('@')
-            mqtt_topic = mqtt_uri.path
+        return result
 
-            if len(mqtt_params) == 1:
-                mqtt_username, mqtt_password = None, None
-                mqtt_host, mqtt_port = mqtt_params[0].split(':')
-            elif len(mqtt_params) == 2:
-                mqtt_username, mqtt_password = mqtt_params[0].split(':')
-                mqtt_host, mqtt_port = mqtt_params[1].split(':')
+    def _count_alert_changes(self, alerts: dict) -> None:
+        alert_fingerprints = {alert_id: self._create_fingerprint(alert_entity) for alert_id, alert_entity in alerts.items()}
 
-            with GtfsRealtimeServiceAlertPublisher(host=mqtt_host, port=mqtt_port, username=mqtt_username, password=mqtt_password, topic=mqtt_topic, expiration=mqtt_expiration) as mqtt_publisher:
-                mqtt_publisher.publish(alerts)
+        created = sum(1 for alert_id in alert_fingerprints.keys() if alert_id not in self._alert_fingerprints)
+        changed = sum(1 for alert_id, fingerprint in alert_fingerprints.items() if alert_id in self._alert_fingerprints and self._alert_fingerprints[alert_id] != fingerprint)
+        deleted = sum(1 for alert_id in self._alert_fingerprints.keys() if alert_id not in alert_fingerprints)
+
+        metrics.count('alerts', len(alerts))
+        metrics.count('alerts_created', created)
+        metrics.count('alerts_changed', changed)
+        metrics.count('alerts_deleted', deleted)
+
+        self._alert_fingerprints = alert_fingerprints
+
+    def _write_output(self, alerts: dict, output_filename: str, mqtt_uri: str, mqtt_expiration: int) -> None:
+        if mqtt_uri is not None:
+            logging.info("publishing to MQTT ...")
+
+            # the MQTT connection is kept alive for subsequent cycles
+            if self._mqtt_publisher is None:
+                self._mqtt_publisher = self._create_mqtt_publisher(mqtt_uri, mqtt_expiration)
+                self._mqtt_publisher.start()
+
+            self._mqtt_publisher.publish(alerts)
 
             logging.info("MQTT publishing done")
-        else:
+        elif output_filename is not None:
             logging.info("writing output file ...")
 
-            feed_message = dict()
-            feed_message['header'] = {
-                'gtfs_realtime_version': '2.0',
-                'incrementality': 'FULL_DATASET',
-                'timestamp': int(time.time())
-            } 
-
-            feed_message['entity'] = list()
-            for alert_id, alert_entity in alerts.items():
-                feed_message['entity'].append({
-                    'id': alert_id,
-                    'alert': alert_entity
-                })
-
-                # log incident for debugging purposes
+            # log incidents for debugging purposes
+            for alert_entity in alerts.values():
                 logging.info(f"{alert_entity}")
 
-            if output_filename.endswith('.json'):
-                with open(output_filename, 'wb') as output_file:
-                    output_file.write(json.dumps(feed_message, indent=2, ensure_ascii=False).encode('utf-8'))
-            elif output_filename.endswith('.pbf'):
-                with open(output_filename, 'wb') as output_file:
-                    pbf_object = gtfs_realtime_pb2.FeedMessage()
-                    ParseDict(feed_message, pbf_object)
+            from . import feed
 
-                    output_file.write(pbf_object.SerializeToString())
+            if self._differential:
+                written = feed.write_differential_feed_file(alerts, output_filename, self._snapshot_interval)
+            else:
+                written = feed.write_feed_file(alerts, output_filename)
 
-            logging.info("output file created")
+            if written:
+                logging.info("output file created")
+            else:
+                logging.info("output file unchanged")
 
-    def _any_template_available(self, incident: dict) -> bool:
-        if incident['properties']['events'] is None:
-            return False
+    def _create_fingerprint(self, data: dict) -> bytes:
+        return hashlib.sha1(json.dumps(data, sort_keys=True, separators=(',', ':'), default=Route.to_dict).encode('utf-8')).digest()
 
-        for template in self._templates:
-             if self._template_available(template, incident):
-                 return True
+    def _create_translated_string(self, template: ServiceAlertTemplate, type: str, data: dict, data_fingerprint: bytes) -> dict:
 
-        return False
-    
-    def _template_available(self, template: dict, incident: dict) -> bool:
-        incident_codes = [e['code'] for e in incident['properties']['events']]
-
-        available = False
-        for template_condition in template['conditions']:
-            if template_condition['code'] in incident_codes:
-                available = True
-            
-            if 'or' in template_condition:
-                for or_code in template_condition['or']:
-                    available = available or or_code in incident_codes 
-        
-            if 'delay' in incident['properties'] and 'delay' in template_condition and incident['properties']['delay'] is not None and incident['properties']['delay'] < template_condition['delay']:
-                available = False
-        
-        return available
-    
-    def _test_pattern_match(self, pattern: dict, incident_shape: any) -> bool:
-        pattern_coordinates = polyline.decode(
-            pattern['patternGeometry']['points']
-        )
+        # texts only depend on the template and the data they're rendered with,
+        # cached texts are shared between alerts and must not be modified
+        cache_key = (id(template), type, data_fingerprint)
+        if cache_key in self._text_cache:
+            self._text_cache.move_to_end(cache_key)
+            self._text_cache_hits = self._text_cache_hits + 1
 
-        pattern_shape = LineString([c[::-1] for c in pattern_coordinates])
-        pattern_shape = transform(Transformer.from_crs(CRS('EPSG:4326'), CRS('EPSG:3857'), always_xy=True).transform, pattern_shape)
+            return self._text_cache[cache_key]
 
-        if type(incident_shape) == LineString:
+        translated_string = self._render_translated_string(template, type, **data)
 
-            # Note: Intersection length should be a minimum of 40m with buffer size of 5m to avoid 
-            # incident alerts for lines which are only crossing an incident, as they might not be affected.
-            # Be aware, that an intersection could happen in an angle of 90° (a normal crossing) but
-            # also can happen in an angle different than 90 degrees (e.g. a street located below or above another street).
-            # The buffer transforms the incident shape into a polygon which leads to a longer intersection at all!
-            
-            incident_shape = incident_shape.buffer(5.0)
-            intersection = pattern_shape.intersection(incident_shape)
+        self._text_cache[cache_key] = translated_string
+        if len(self._text_cache) > self._text_cache_size:
+            self._text_cache.popitem(last=False)
 
-            if intersection.length >= 40.0:
-                return True
-        
-        return False
-    
-    def _create_translated_string(self, template: dict, type: str, **data) -> dict:
+        self._text_cache_misses = self._text_cache_misses + 1
+
+        return translated_string
+
+    def _render_translated_string(self, template: ServiceAlertTemplate, type: str, **data) -> dict:
         translated_string = dict()
         translated_string['translation'] = list()
 
-        if type in template:
-            for lang, text in template[type].items():
-                tmpl = Template(text)
+        if type in template.texts:
+            for lang, tmpl in template.texts[type].items():
                 translated_string['translation'].append({
                     'language': lang,
                     'text': tmpl.render(
@@ -204,25 +333,28 @@ class OtpGtfsMatcher:
 
         return translated_string
     
-    def _create_service_alert(self, template: dict, incident: dict, **data) -> tuple:
+    def _create_service_alert(self, template: ServiceAlertTemplate, incident: dict, **data) -> tuple:
         
         root_uuid = uuid.UUID('0715e0ca-0427-49ce-b3c8-5f83b400d00b')
         alert_id = str(uuid.uuid5(namespace=root_uuid, name=incident['properties']['id']))
         
         alert_entity = {
-            'cause': template['cause'],
-            'effect': template['effect']
+            'cause': template.cause,
+            'effect': template.effect
         }
 
         alert_entity['informed_entity'] = list()
         for line in data['affectedLines']:
             alert_entity['informed_entity'].append({
-                'route_id': line['gtfsId']
+                'route_id': line.gtfsId
             })
 
-        alert_entity['url'] = self._create_translated_string(template, 'url', **{'id': alert_id})
-        alert_entity['header_text'] = self._create_translated_string(template, 'header', **data)
-        alert_entity['description_text'] = self._create_translated_string(template, 'description', **data)
+        url_data = {'id': alert_id}
+        data_fingerprint = self._create_fingerprint(data)
+
+        alert_entity['url'] = self._create_translated_string(template, 'url', url_data, self._create_fingerprint(url_data))
+        alert_entity['header_text'] = self._create_translated_string(template, 'header', data, data_fingerprint)
+        alert_entity['description_text'] = self._create_translated_string(template, 'description', data, data_fingerprint)
 
         return alert_id, alert_entity
 
@@ -0,0 +1,112 @@
+import contextvars
+import threading
+import time
+
+from contextlib import contextmanager
+
+
+class Metrics:
+
+    def __init__(self, prefix: str = 'gtfs_incident_alerts'):
+        self._prefix = prefix
+        self._lock = threading.Lock()
+
+        # the current cycle is tracked per context, so that cycles
+        # of multiple jobs can run concurrently in their own threads
+        self._cycle = contextvars.ContextVar('cycle', default=None)
+
+        self._cycles = dict()
+
+        self._stage_seconds = dict()
+        self._stage_seconds_total = dict()
+        self._counts = dict()
+        self._counts_total = dict()
+
+    def start_cycle(self, job: str = 'default') -> None:
+        self._cycle.set({
+            'job': job,
+            'start': time.perf_counter(),
+            'stats': {'stages': dict(), 'counts': dict()}
+        })
+
+    def end_cycle(self) -> dict:
+        cycle = self._cycle.get()
+        self._cycle.set(None)
+
+        job = cycle['job']
+        duration = time.perf_counter() - cycle['start']
+
+        with self._lock:
+            self._cycles[job] = self._cycles.get(job, 0) + 1
+            self._stage_seconds[(job, 'cycle')] = duration
+            self._stage_seconds_total[(job, 'cycle')] = self._stage_seconds_total.get((job, 'cycle'), 0.0) + duration
+
+            cycle_stats = cycle['stats']
+            cycle_stats['stages'] = {name: round(seconds, 6) for name, seconds in cycle_stats['stages'].items()}
+            cycle_stats['duration'] = round(duration, 6)
+
+        return cycle_stats
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_stage(name, time.perf_counter() - start)
+
+    def record_stage(self, name: str, seconds: float) -> None:
+        cycle = self._cycle.get()
+        key = (cycle['job'] if cycle is not None else 'default', name)
+
+        with self._lock:
+            self._stage_seconds_total[key] = self._stage_seconds_total.get(key, 0.0) + seconds
+
+            # a stage may run several times per cycle, the gauge reports its sum
+            if cycle is not None:
+                cycle['stats']['stages'][name] = cycle['stats']['stages'].get(name, 0.0) + seconds
+                self._stage_seconds[key] = cycle['stats']['stages'][name]
+            else:
+                self._stage_seconds[key] = seconds
+
+    def count(self, name: str, value: int) -> None:
+        cycle = self._cycle.get()
+        key = (cycle['job'] if cycle is not None else 'default', name)
+
+        with self._lock:
+            self._counts[key] = value
+            self._counts_total[key] = self._counts_total.get(key, 0) + value
+
+            if cycle is not None:
+                cycle['stats']['counts'][name] = cycle['stats']['counts'].get(name, 0) + value
+
+    def render(self) -> str:
+        lines = list()
+        with self._lock:
+            lines.append(f"# TYPE {self._prefix}_cycles_total counter")
+            for job, cycles in sorted(self._cycles.items()):
+                lines.append(f"{self._prefix}_cycles_total{{job=\"{job}\"}} {cycles}")
+
+            lines.append(f"# TYPE {self._prefix}_stage_duration_seconds gauge")
+            for (job, name), seconds in sorted(self._stage_seconds.items()):
+                lines.append(f"{self._prefix}_stage_duration_seconds{{job=\"{job}\",stage=\"{name}\"}} {seconds:.6f}")
+
+            lines.append(f"# TYPE {self._prefix}_stage_duration_seconds_total counter")
+            for (job, name), seconds in sorted(self._stage_seconds_total.items()):
+                lines.append(f"{self._prefix}_stage_duration_seconds_total{{job=\"{job}\",stage=\"{name}\"}} {seconds:.6f}")
+
+            for count_name in sorted(set(name for _, name in self._counts.keys())):
+                lines.append(f"# TYPE {self._prefix}_{count_name} gauge")
+                for (job, name), value in sorted(self._counts.items()):
+                    if name == count_name:
+                        lines.append(f"{self._prefix}_{name}{{job=\"{job}\"}} {value}")
+
+                lines.append(f"# TYPE {self._prefix}_{count_name}_total counter")
+                for (job, name), value in sorted(self._counts_total.items()):
+                    if name == count_name:
+                        lines.append(f"{self._prefix}_{name}_total{{job=\"{job}\"}} {value}")
+
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
@@ -0,0 +1,78 @@
+import json
+import logging
+import os
+import sqlite3
+
+
+class MqttMirror:
+
+    def __init__(self, filename: str, topic: str):
+        self._topic = topic
+
+        self._connection = sqlite3.connect(filename, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS alerts (
+                topic TEXT NOT NULL,
+                alert_id TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                alert TEXT NOT NULL,
+                published REAL NOT NULL,
+                PRIMARY KEY (topic, alert_id)
+            )
+        """)
+        self._connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, exception_traceback) -> None:
+        if exception_type is None:
+            self._connection.commit()
+        else:
+            self._connection.rollback()
+
+    def load(self) -> dict:
+        cursor = self._connection.execute('SELECT alert_id, hash, published FROM alerts WHERE topic = ?', (self._topic,))
+        return {alert_id: (alert_hash, published) for alert_id, alert_hash, published in cursor}
+
+    def get_alert(self, alert_id: str) -> dict | None:
+        row = self._connection.execute('SELECT alert FROM alerts WHERE topic = ? AND alert_id = ?', (self._topic, alert_id)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def upsert(self, alert_id: str, alert_hash: str, alert_entity: dict, published: float) -> None:
+        self._connection.execute(
+            'INSERT INTO alerts (topic, alert_id, hash, alert, published) VALUES (?, ?, ?, ?, ?) ON CONFLICT (topic, alert_id) DO UPDATE SET hash = excluded.hash, alert = excluded.alert, published = excluded.published',
+            (self._topic, alert_id, alert_hash, json.dumps(alert_entity), published)
+        )
+
+    def delete(self, alert_id: str) -> None:
+        self._connection.execute('DELETE FROM alerts WHERE topic = ? AND alert_id = ?', (self._topic, alert_id))
+
+    def import_legacy_mirror(self, legacy_filename: str) -> None:
+        if not os.path.exists(legacy_filename):
+            return
+
+        # alerts of the legacy JSON mirror are imported without hash,
+        # so that they're published again once
+        try:
+            with open(legacy_filename, 'r') as legacy_file:
+                legacy_mirror = json.loads(legacy_file.read())
+
+            with self:
+                for alert_id, mirror_entry in legacy_mirror.items():
+                    alert_entity = mirror_entry['alert'] if 'hash' in mirror_entry else mirror_entry
+                    self._connection.execute(
+                        'INSERT OR IGNORE INTO alerts (topic, alert_id, hash, alert, published) VALUES (?, ?, ?, ?, ?)',
+                        (self._topic, alert_id, '', json.dumps(alert_entity), 0.0)
+                    )
+
+            os.remove(legacy_filename)
+
+            logging.info(f"MQTT Mirror: Imported {len(legacy_mirror)} alerts of legacy mirror {legacy_filename}")
+        except (OSError, json.decoder.JSONDecodeError) as ex:
+            logging.warning(f"MQTT Mirror: Could not import legacy mirror {legacy_filename}: {ex}")
+
+    def close(self) -> None:
+        self._connection.close()
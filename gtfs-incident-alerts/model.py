@@ -0,0 +1,178 @@
+import hashlib
+import json
+import numpy
+
+from array import array
+
+
+def decode_polyline(expression: str, precision: int = 5) -> numpy.ndarray:
+
+    # decode all values of an encoded polyline at once, each value consists of 5-bit chunks
+    # where all but the last one have the continuation bit 0x20 set
+    chunks = numpy.frombuffer(expression.encode('ascii'), dtype=numpy.uint8).astype(numpy.int64) - 63
+    if len(chunks) == 0:
+        return numpy.empty((0, 2), dtype=float)
+
+    last_chunks = (chunks & 0x20) == 0
+    value_starts = numpy.flatnonzero(numpy.concatenate(([True], last_chunks[:-1])))
+    chunk_positions = numpy.arange(len(chunks)) - numpy.repeat(value_starts, numpy.diff(numpy.append(value_starts, len(chunks))))
+
+    values = numpy.add.reduceat((chunks & 0x1f) << (5 * chunk_positions), value_starts)
+    values = numpy.where(values & 1, ~(values >> 1), values >> 1)
+
+    # values are deltas of alternating lat and lon, accumulated as integers
+    # like the reference implementation, so that the result is the same
+    return numpy.cumsum(values.reshape(-1, 2), axis=0) / float(10 ** precision)
+
+
+class Route:
+
+    __slots__ = ('gtfsId', 'shortName', 'longName', 'mode', 'type')
+
+    def __init__(self, gtfsId: str, shortName: str = None, longName: str = None, mode: str = None, type: int = None):
+        self.gtfsId = gtfsId
+        self.shortName = shortName
+        self.longName = longName
+        self.mode = mode
+        self.type = type
+
+    # templates are python code using routes like dicts, e.g. line['shortName'],
+    # 'longName' in line or line.items(), so they behave like read-only dicts
+    def __getitem__(self, key: str):
+        if key not in self.__slots__:
+            raise KeyError(key)
+
+        return getattr(self, key)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.__slots__
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self) -> int:
+        return len(self.__slots__)
+
+    def get(self, key: str, default=None):
+        return getattr(self, key) if key in self.__slots__ else default
+
+    def keys(self) -> tuple:
+        return self.__slots__
+
+    def values(self) -> list:
+        return [getattr(self, key) for key in self.__slots__]
+
+    def items(self) -> list:
+        return [(key, getattr(self, key)) for key in self.__slots__]
+
+    def to_dict(self) -> dict:
+        return {key: getattr(self, key) for key in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, route: dict) -> 'Route':
+        return cls(route['gtfsId'], route.get('shortName'), route.get('longName'), route.get('mode'), route.get('type'))
+
+
+class PatternSet:
+
+    __slots__ = ('routes', 'route_indices', 'geometry_indices', 'starts', 'ends', 'coordinates')
+
+    def __init__(self, routes: list, route_indices: numpy.ndarray, geometry_indices: numpy.ndarray, starts: numpy.ndarray = None, ends: numpy.ndarray = None, coordinates: numpy.ndarray = None):
+
+        # each route exists only once, patterns reference their route and their geometry by index,
+        # the points of each geometry are a range of one flat lat/lon coordinate array
+        self.routes = routes
+        self.route_indices = route_indices
+        self.geometry_indices = geometry_indices
+        self.starts = starts
+        self.ends = ends
+        self.coordinates = coordinates
+
+    def __len__(self) -> int:
+        return len(self.route_indices)
+
+    def route(self, index: int) -> Route:
+        return self.routes[self.route_indices[index]]
+
+    def points(self, geometry_index: int) -> numpy.ndarray:
+        return self.coordinates[self.starts[geometry_index]:self.ends[geometry_index]]
+
+    def deduplicate(self) -> 'PatternSet':
+
+        # many patterns share the same points, e.g. variants of the same route or the same
+        # route in multiple feeds, so each distinct geometry needs to be matched only once
+        geometry_keys = dict()
+        geometry_map = numpy.empty(len(self.starts), dtype=numpy.int32)
+        for geometry_index in range(len(self.starts)):
+            geometry_key = hashlib.sha1(self.points(geometry_index).tobytes()).digest()
+            geometry_map[geometry_index] = geometry_keys.setdefault(geometry_key, len(geometry_keys))
+
+        unique_geometries = numpy.unique(geometry_map, return_index=True)[1]
+
+        return PatternSet(
+            self.routes,
+            self.route_indices,
+            geometry_map[self.geometry_indices],
+            self.starts[unique_geometries],
+            self.ends[unique_geometries],
+            self.coordinates
+        )
+
+    def content_hash(self) -> str:
+        content_hash = hashlib.sha256()
+        content_hash.update(json.dumps([route.to_dict() for route in self.routes], sort_keys=True).encode('utf-8'))
+
+        for values in [self.route_indices, self.geometry_indices, self.starts, self.ends, self.coordinates]:
+            content_hash.update(numpy.ascontiguousarray(values).tobytes())
+
+        return content_hash.hexdigest()
+
+    def without_coordinates(self) -> 'PatternSet':
+        return PatternSet(self.routes, self.route_indices, self.geometry_indices)
+
+
+class PatternSetBuilder:
+
+    def __init__(self):
+        self._routes = list()
+        self._route_indices = dict()
+
+        self._pattern_routes = array('i')
+        self._pattern_ends = array('q')
+        self._coordinates = array('d')
+
+    def add_route(self, route: Route) -> int:
+
+        # routes are interned by their ID
+        if route.gtfsId not in self._route_indices:
+            self._route_indices[route.gtfsId] = len(self._routes)
+            self._routes.append(route)
+
+        return self._route_indices[route.gtfsId]
+
+    def add_pattern(self, route_index: int, points) -> None:
+        if isinstance(points, str):
+            points = decode_polyline(points)
+
+        # patterns without a line geometry, e.g. of an empty polyline, can't be matched
+        if len(points) < 2:
+            return
+
+        self._coordinates.frombytes(numpy.ascontiguousarray(points, dtype=float).tobytes())
+
+        self._pattern_routes.append(route_index)
+        self._pattern_ends.append(len(self._coordinates) // 2)
+
+    def build(self) -> PatternSet:
+        ends = numpy.array(self._pattern_ends, dtype=numpy.int64)
+        starts = numpy.zeros_like(ends)
+        starts[1:] = ends[:-1]
+
+        return PatternSet(
+            self._routes,
+            numpy.array(self._pattern_routes, dtype=numpy.int32),
+            numpy.arange(len(ends), dtype=numpy.int32),
+            starts,
+            ends,
+            numpy.frombuffer(self._coordinates, dtype=float).reshape(-1, 2)
+        )
@@ -1,95 +1,163 @@
+import hashlib
 import json
 import logging
 import os
+import threading
 import time
 
 from appdirs import site_data_dir
-from google.transit import gtfs_realtime_pb2
-from google.protobuf.json_format import ParseDict
 from paho.mqtt import client
 from paho.mqtt.packettypes import PacketTypes
 from paho.mqtt.properties import Properties
 
+from .feed import create_feed_message
+from .mirror import MqttMirror
 from .version import version
 
+class MqttConnection:
+
+    def __init__(self, host, port, username, password):
+
+        # connecto to MQTT broker as defined in config
+        self.client = client.Client(client.CallbackAPIVersion.VERSION2, protocol=client.MQTTv5)
+
+        if username is not None and password is not None:
+            self.client.username_pw_set(username=username, password=password)
+
+        self.client.connect(host, int(port))
+
+        # a connection may be shared by several publishers,
+        # its network loop runs as long as one of them is started
+        self._references = 0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        with self._lock:
+            if self._references == 0:
+                self.client.loop_start()
+
+            self._references = self._references + 1
+
+    def release(self) -> None:
+        with self._lock:
+            self._references = self._references - 1
+
+            if self._references == 0:
+                self.client.loop_stop()
+                self.client.disconnect()
+
+
 class GtfsRealtimeServiceAlertPublisher:
 
-    def __init__(self, host, port, username, password, topic, expiration):
+    _expiration_margin = 0.1
+
+    def __init__(self, host, port, username, password, topic, expiration, mirror_dir=None, connection: MqttConnection = None, interval: float = None):
 
         self._expiration = expiration
 
-        # connecto to MQTT broker as defined in config
+        # unchanged alerts are published again every cycle
+        # if the interval of the publishing cycles is unknown
+        self._interval = interval
+
         topic = topic.replace('+', '_')
         topic = topic.replace('#', '_')
         topic = topic.replace('$', '_')
         
         self._topic = topic
 
-        self._mqtt = client.Client(client.CallbackAPIVersion.VERSION2, protocol=client.MQTTv5)
+        self._connection = connection if connection is not None else MqttConnection(host, port, username, password)
+        self._mqtt = self._connection.client
 
-        if username is not None and password is not None:
-            self._mqtt.username_pw_set(username=username, password=password)
+        # open MQTT mirror for tracking the state of all published alerts
+        mqtt_mirror_dir = mirror_dir if mirror_dir is not None else site_data_dir(appname='gtfs-incident-alerts', appauthor='skc', version=version)
+        if not os.path.exists(mqtt_mirror_dir):
+            os.makedirs(mqtt_mirror_dir)
 
-        self._mqtt.connect(host, int(port))
+        mqtt_mirror_filename = os.path.join(mqtt_mirror_dir, 'mqtt.sqlite')
+        logging.info(f"MQTT Mirror: Filename is {mqtt_mirror_filename}")
+
+        self._mirror = MqttMirror(mqtt_mirror_filename, self._topic)
+        self._mirror.import_legacy_mirror(os.path.join(mqtt_mirror_dir, 'mqtt.mirror'))
     
     def __enter__(self) -> None:
-        self._mqtt.loop_start()
+        self.start()
 
         return self
 
     def __exit__(self, exception_type, exception_value, exception_traceback) -> None:
-        self._mqtt.loop_stop()
-        self._mqtt.disconnect()
+        self.stop()
+
+    def start(self) -> None:
+        self._connection.acquire()
+
+    def stop(self) -> None:
+        self._connection.release()
+
+        self._mirror.close()
 
     def publish(self, alerts: dict) -> None:
-        mqtt_mirror_dir = site_data_dir(appname='gtfs-incident-alerts', appauthor='skc', version=version)
-        if not os.path.exists(mqtt_mirror_dir):
-            os.makedirs(mqtt_mirror_dir)
-            
-        mqtt_mirror_filename = os.path.join(mqtt_mirror_dir, 'mqtt.mirror')
-        if not os.path.exists(mqtt_mirror_filename):
-            with open(mqtt_mirror_filename, 'w') as mqtt_mirror_file:
-                mqtt_mirror_file.write('{}')
+        mqtt_mirror = self._mirror.load()
 
-        logging.info(f"MQTT Mirror: Filename is {mqtt_mirror_filename}")
+        # publish all new or changed alerts and refresh retained messages
+        # before they expire, unchanged alerts are not published again
+        now = time.time()
+
+        published_messages = list()
+        for alert_id, alert_entity in alerts.items():
+            alert_hash = self._create_hash(alert_entity)
+
+            if alert_id not in mqtt_mirror:
+                logging.info(f"MQTT Mirror: Alert {alert_id} added")
+            elif mqtt_mirror[alert_id][0] != alert_hash:
+                logging.info(f"MQTT Mirror: Alert {alert_id} changed")
+            elif self._is_expiring(now - mqtt_mirror[alert_id][1]):
+                logging.info(f"MQTT Mirror: Alert {alert_id} refreshed")
+            else:
+                continue
+
+            message = self._publish(alert_id, alert_entity)
+            published_messages.append((message, alert_id, alert_hash, alert_entity))
 
-        with open(mqtt_mirror_filename, 'r+') as mqtt_mirror_file:
+        # run over mirror and find all alerts which are not present anymore
+        # publish them as deleted entity and delete them form mirror
+        for alert_id in mqtt_mirror.keys():
+            if alert_id not in alerts:
+                logging.info(f"MQTT Mirror: Alert {alert_id} removed")
 
-            # read MQTT mirror
-            try:
-                mqtt_mirror = json.loads(mqtt_mirror_file.read())
-            except json.decoder.JSONDecodeError:
-                mqtt_mirror = dict()
+                message = self._publish(alert_id, self._mirror.get_alert(alert_id), True)
+                published_messages.append((message, alert_id, None, None))
 
-            # publish all active alerts
-            # add them to MQTT mirror, if not already present
-            for alert_id, alert_entity in alerts.items():
-                if alert_id not in mqtt_mirror:
-                    mqtt_mirror[alert_id] = alert_entity
-                    
-                    logging.info(f"MQTT Mirror: Alert {alert_id} added successfully")
+        # wait for all messages being published and update the mirror
+        # messages which could not be published are retried in the next cycle
+        with self._mirror:
+            for message, alert_id, alert_hash, alert_entity in published_messages:
+                try:
+                    message.wait_for_publish(timeout=10.0)
+                except (RuntimeError, ValueError) as ex:
+                    logging.error(f"MQTT: Alert {alert_id} could not be published: {ex}")
 
-                self._publish(alert_id, alert_entity)
+                if not message.is_published():
+                    continue
 
-            # run over mirror and find all alerts which are not present anymore
-            # publish them as deleted entity and delete them form mirror
-            deleted_alerts_ids = list()
-            for alert_id, alert_entity in mqtt_mirror.items():
-                if alert_id not in alerts:
-                    deleted_alerts_ids.append(alert_id)
-                    logging.info(f"MQTT Mirror: Alert {alert_id} removed successfully")
+                if alert_entity is not None:
+                    self._mirror.upsert(alert_id, alert_hash, alert_entity, now)
+                else:
+                    self._mirror.delete(alert_id)
 
-                    self._publish(alert_id, alert_entity, True)
-            
-            for deleted_alert_id in deleted_alerts_ids:
-                del mqtt_mirror[deleted_alert_id]
+        logging.info(f"MQTT Mirror: Published {len(published_messages)} of {len(alerts)} active alerts")
 
-            # write back MQTT mirror
-            mqtt_mirror_file.truncate(0)
-            mqtt_mirror_file.seek(0)
-            mqtt_mirror_file.write(json.dumps(mqtt_mirror))
+    def _is_expiring(self, age: float) -> bool:
+        if self._interval is None:
+            return True
 
-    def _publish(self, alert_id: str, alert_entity: dict, is_deleted: bool = False) -> None:
+        # the retained message must not expire before the next cycle, which
+        # may publish a little later than this one after its own start
+        return age + self._interval >= self._expiration * (1.0 - self._expiration_margin)
+
+    def _create_hash(self, alert_entity: dict) -> str:
+        return hashlib.sha256(json.dumps(alert_entity, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _publish(self, alert_id: str, alert_entity: dict, is_deleted: bool = False) -> client.MQTTMessageInfo:
 
         # generate MQTT topic from placeholders
         # remove leading / if present, see #6 for reference
@@ -100,36 +168,15 @@ class GtfsRealtimeServiceAlertPublisher:
             topic = topic[1:]
 
         # generate feed message containing a single alert
-        feed_message = dict()
-        feed_message['header'] = {
-            'gtfs_realtime_version': '2.0',
-            'incrementality': 'DIFFERENTIAL',
-            'timestamp': int(time.time())
-        }
-
-        feed_message['entity'] = list()
-
-        # publish message
+        # deleted alerts are published with the is_deleted flag
         if is_deleted:
-            # delete message from MQTT
-            feed_message['entity'].append({
-                'id': alert_id,
-                'alert': alert_entity,
-                'is_deleted': True
-            })
+            feed_message = create_feed_message(dict(), 'DIFFERENTIAL', {alert_id: alert_entity})
         else:
-            # convert to PBF message and publish
-            feed_message['entity'].append({
-                'id': alert_id,
-                'alert': alert_entity
-            })
+            feed_message = create_feed_message({alert_id: alert_entity}, 'DIFFERENTIAL')
         
         logging.info(f"MQTT: Published GTFS-RT feed message f{feed_message}")
-            
-        pbf_object = gtfs_realtime_pb2.FeedMessage()
-        ParseDict(feed_message, pbf_object)
 
         properties = Properties(PacketTypes.PUBLISH)
         properties.MessageExpiryInterval = self._expiration
 
-        self._mqtt.publish(topic, pbf_object.SerializeToString(), 0, True, properties) 
\ No newline at end of file
+        return self._mqtt.publish(topic, feed_message.SerializeToString(), 0, True, properties) 
\ No newline at end of file
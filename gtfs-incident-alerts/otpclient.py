@@ -1,58 +1,218 @@
-from gql import gql, Client
-from gql.transport.httpx import HTTPXTransport
+import httpx
+import ijson
+import logging
+import time
+
+from datetime import datetime, timedelta
+
+from .model import PatternSet, PatternSetBuilder, Route
 
 
 class OtpClient:
 
+    _route_batch_size = 250
+
     def __init__(self, otp_url: str):
-        gql_transport = HTTPXTransport(url=otp_url)
-        self._gql_client = Client(transport=gql_transport, fetch_schema_from_transport=False)
-        self._gql_query = """
-        query PatternsWithShapes($date: String!) {
-            patterns {
-                headsign
-                directionId
-                route {
-                    gtfsId
-                    shortName
-                    longName
-                    mode
-                    type
-                }
-                tripsForDate(serviceDate: $date) {
-                    gtfsId
+        self._otp_url = otp_url
+
+        # use a pooled HTTP client for all requests
+        self._http_client = httpx.Client(timeout=httpx.Timeout(10.0, read=120.0))
+
+        # route IDs are requested first and their patterns in batches of routes, so that
+        # no single response contains the patterns of a whole statewide deployment
+        self._route_ids_query = """
+        query RouteIds {
+            routeIds: routes {
+                gtfsId
+            }
+        }
+        """
+
+        # request only what the matcher needs, patterns are filtered
+        # by their service dates on the server if OTP supports it
+        self._routes_query = """
+        query RoutesWithPatterns($ids: [String], $serviceDates: LocalDateRangeInput) {
+            routes(ids: $ids) {
+                gtfsId
+                shortName
+                longName
+                mode
+                type
+                patterns(serviceDates: $serviceDates) {
+                    patternGeometry {
+                        points
+                    }
                 }
-                patternGeometry {
-                    points
+            }
+        }
+        """
+
+        # older OTP versions can only list the trips of each pattern for testing
+        # whether it is active, their shortest field is requested then
+        self._legacy_routes_query = """
+        query RoutesWithPatterns($ids: [String], $date: String!) {
+            routes(ids: $ids) {
+                gtfsId
+                shortName
+                longName
+                mode
+                type
+                patterns {
+                    patternGeometry {
+                        points
+                    }
+                    tripsForDate(serviceDate: $date) {
+                        gtfsId
+                    }
                 }
             }
         }
         """
-        
-    def load_active_pattern(self, date: str) -> dict:
-        gql_result = self._gql_client.execute(gql(self._gql_query), variable_values={
-            'date': date
-        })
 
-        result = list()
-        if gql_result['patterns'] is not None:
-            for pattern in gql_result['patterns']:
-                if pattern['patternGeometry'] is None:
-                    continue
+        self._service_dates_supported = True
+
+    def load_active_pattern(self, date: str, deadline: float = None) -> PatternSet:
+        patterns = PatternSetBuilder()
+
+        route_ids = self._execute(self._route_ids_query, dict(), deadline=deadline).get('routeIds') or []
+        for batch_start in range(0, len(route_ids), self._route_batch_size):
+            self._load_routes(route_ids[batch_start:batch_start + self._route_batch_size], date, patterns, deadline)
+
+        return patterns.build()
 
-                if len(pattern['tripsForDate']) == 0:
-                    continue
+    def close(self) -> None:
+        self._http_client.close()
 
-                del pattern['tripsForDate']
+    def _load_routes(self, route_ids: list, date: str, patterns: PatternSetBuilder, deadline: float = None) -> None:
+        if self._service_dates_supported:
+            next_date = (datetime.strptime(date, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+
+            # OTP rejects the whole query if it doesn't know the argument,
+            # either with a validation error or a bad request, so no pattern has been added yet
+            try:
+                self._execute(self._routes_query, {'ids': route_ids, 'serviceDates': {'start': date, 'end': next_date}}, patterns, deadline)
+                return
+            except RuntimeError as ex:
+                if 'serviceDates' not in str(ex) and 'LocalDateRangeInput' not in str(ex):
+                    raise
+            except httpx.HTTPStatusError as ex:
+                if ex.response.status_code != 400:
+                    raise
+
+            logging.info('OTP Client: Filtering patterns by service dates is not supported, requesting their trips instead')
+            self._service_dates_supported = False
+
+        self._execute(self._legacy_routes_query, {'ids': route_ids, 'date': date}, patterns, deadline)
+
+    def _execute(self, query: str, variables: dict, patterns: PatternSetBuilder = None, deadline: float = None) -> dict:
+        request = {
+            'query': query,
+            'variables': variables
+        }
 
-                pattern['route']['gtfsId'] = self._strip_feed_id(pattern['route']['gtfsId'])
+        with self._http_client.stream('POST', self._otp_url, json=request, timeout=self._get_timeout(deadline)) as response:
+            response.raise_for_status()
 
-                result.append(pattern)
+            # parse the response as stream of events, so that routes and
+            # patterns are only created if they're active on the date
+            events = ijson.sendable_list()
+            parser = ijson.parse_coro(events)
+
+            builder = _ResponseBuilder(patterns, self._strip_feed_id)
+            for chunk in response.iter_bytes():
+                if deadline is not None and time.monotonic() > deadline:
+                    raise httpx.ReadTimeout('cycle deadline exceeded while loading patterns')
+
+                parser.send(chunk)
+
+                for prefix, event, value in events:
+                    builder.handle(prefix, event, value)
+
+                del events[:]
+
+            parser.close()
+            for prefix, event, value in events:
+                builder.handle(prefix, event, value)
+
+        if len(builder.errors) > 0:
+            raise RuntimeError(f"OTP GraphQL errors: {builder.errors}")
+
+        return builder.data
+
+    def _get_timeout(self, deadline: float) -> httpx.Timeout:
+        if deadline is None:
+            return self._http_client.timeout
+
+        # requests must not take longer than the remainder of the cycle
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise httpx.ConnectTimeout('cycle deadline exceeded before loading patterns')
+
+        return httpx.Timeout(min(self._http_client.timeout.connect, remaining), read=min(self._http_client.timeout.read, remaining))
 
-        return result
-    
     def _strip_feed_id(self, obj_id: str) -> str:
         if ':' in obj_id:
             return obj_id[obj_id.find(':') + 1:]
         else:
             return obj_id
+
+
+class _ResponseBuilder:
+
+    _route_prefix = 'data.routes.item'
+    _route_fields = ['gtfsId', 'shortName', 'longName', 'mode', 'type']
+
+    def __init__(self, patterns: PatternSetBuilder, strip_feed_id):
+        self._patterns = patterns
+        self._strip_feed_id = strip_feed_id
+
+        self.data = dict()
+        self.errors = list()
+
+        self._route = None
+        self._route_points = None
+        self._pattern_points = None
+        self._pattern_trips = None
+
+    def handle(self, prefix: str, event: str, value: any) -> None:
+        if prefix == 'errors.item.message':
+            self.errors.append(value)
+        elif prefix == 'data.routeIds.item.gtfsId':
+            self.data.setdefault('routeIds', list()).append(value)
+        elif prefix == self._route_prefix:
+            if event == 'start_map':
+                self._route = dict()
+                self._route_points = list()
+            elif event == 'end_map':
+                self._create_route_patterns()
+        elif prefix == f"{self._route_prefix}.patterns.item":
+            # patterns filtered by their service dates on the server
+            # have no trips listed and are active in any case
+            if event == 'start_map':
+                self._pattern_points = None
+                self._pattern_trips = None
+            elif event == 'end_map' and self._pattern_points is not None and self._pattern_trips != 0:
+                self._route_points.append(self._pattern_points)
+        elif prefix == f"{self._route_prefix}.patterns.item.patternGeometry.points":
+            self._pattern_points = value
+        elif prefix == f"{self._route_prefix}.patterns.item.tripsForDate" and event == 'start_array':
+            self._pattern_trips = 0
+        elif prefix == f"{self._route_prefix}.patterns.item.tripsForDate.item" and event == 'start_map':
+            self._pattern_trips = self._pattern_trips + 1
+        elif prefix.startswith(f"{self._route_prefix}.") and event not in ['map_key', 'start_map', 'end_map', 'start_array', 'end_array']:
+            field = prefix[len(self._route_prefix) + 1:]
+            if field in self._route_fields:
+                self._route[field] = value
+
+    def _create_route_patterns(self) -> None:
+
+        # routes without any active pattern are dropped
+        if len(self._route_points) == 0:
+            return
+
+        self._route['gtfsId'] = self._strip_feed_id(self._route['gtfsId'])
+
+        # points are decoded right away, so that the encoded polylines can be released
+        route_index = self._patterns.add_route(Route.from_dict(self._route))
+        for points in self._route_points:
+            self._patterns.add_pattern(route_index, points)
@@ -0,0 +1,139 @@
+import glob
+import hashlib
+import json
+import logging
+import numpy
+import os
+import shapely
+import struct
+import time
+
+from appdirs import site_data_dir
+
+from .model import PatternSet, Route
+from .version import version
+
+class PatternCache:
+
+    _magic = b'GIAPC2'
+
+    def __init__(self, source_key: str, cache_dir: str = None):
+        if cache_dir is None:
+            cache_dir = site_data_dir(appname='gtfs-incident-alerts', appauthor='skc', version=version)
+
+        self._cache_dir = cache_dir
+        self._source_key = hashlib.sha1(source_key.encode('utf-8')).hexdigest()[:16]
+
+    def load(self, date: str, max_age: float = None) -> tuple | None:
+        cache_filename = self._find_cache_filename(date)
+        if cache_filename is None:
+            return None
+
+        # patterns may have changed in their source meanwhile, e.g. by redeploying OTP
+        if max_age is not None and time.time() - os.path.getmtime(cache_filename) > max_age:
+            logging.info(f"Pattern Cache: {cache_filename} is outdated")
+            return None
+
+        try:
+            with open(cache_filename, 'rb') as cache_file:
+                if cache_file.read(len(self._magic)) != self._magic:
+                    raise ValueError('invalid file signature')
+
+                header_length, = struct.unpack('<I', cache_file.read(4))
+                header_bytes = cache_file.read(header_length)
+                payload = cache_file.read()
+
+            header = json.loads(header_bytes)
+            if self._content_hash(header['routes'], header['patterns'], header['geometries'], payload) != header['hash']:
+                raise ValueError('content hash mismatch')
+
+            # split payload into WKB geometries and restore shapes
+            offsets = [0]
+            for size in header['sizes']:
+                offsets.append(offsets[-1] + size)
+
+            pattern_shapes = shapely.from_wkb([payload[offsets[i]:offsets[i + 1]] for i in range(len(header['sizes']))])
+            pattern_set = PatternSet([Route.from_dict(r) for r in header['routes']], numpy.array(header['patterns'], dtype=numpy.int32), numpy.array(header['geometries'], dtype=numpy.int32))
+
+        except (OSError, ValueError, KeyError, shapely.errors.GEOSException) as ex:
+            logging.warning(f"Pattern Cache: Could not read {cache_filename}: {ex}")
+            return None
+
+        logging.info(f"Pattern Cache: Loaded {len(pattern_set)} patterns from {cache_filename}")
+
+        # caches of earlier versions lack the hash of the patterns in their source
+        return pattern_set, list(pattern_shapes), header.get('source', header['hash'])
+
+    def store(self, date: str, pattern_set: PatternSet, pattern_shapes: list, source_hash: str) -> None:
+
+        # routes are interned already, only the ones with patterns are stored
+        used_routes, patterns = numpy.unique(pattern_set.route_indices, return_inverse=True)
+
+        routes = [pattern_set.routes[r].to_dict() for r in used_routes]
+        patterns = patterns.reshape(-1).tolist()
+
+        # shapes are stored once per distinct geometry
+        geometries = pattern_set.geometry_indices.tolist()
+
+        wkb_shapes = shapely.to_wkb(pattern_shapes) if len(pattern_shapes) > 0 else []
+        payload = b''.join(wkb_shapes)
+
+        content_hash = self._content_hash(routes, patterns, geometries, payload)
+
+        header_bytes = json.dumps({
+            'date': date,
+            'hash': content_hash,
+            'source': source_hash,
+            'routes': routes,
+            'patterns': patterns,
+            'geometries': geometries,
+            'sizes': [len(s) for s in wkb_shapes]
+        }).encode('utf-8')
+
+        try:
+            if not os.path.exists(self._cache_dir):
+                os.makedirs(self._cache_dir)
+
+            cache_filename = os.path.join(self._cache_dir, f"patterns-{date}-{self._source_key}-{content_hash[:16]}.cache")
+            with open(f"{cache_filename}.tmp", 'wb') as cache_file:
+                cache_file.write(self._magic)
+                cache_file.write(struct.pack('<I', len(header_bytes)))
+                cache_file.write(header_bytes)
+                cache_file.write(payload)
+
+            os.replace(f"{cache_filename}.tmp", cache_filename)
+
+            # remove caches of other service days or pattern sets for this source
+            for outdated_filename in glob.glob(os.path.join(self._cache_dir, f"patterns-*-{self._source_key}-*.cache")):
+                if outdated_filename != cache_filename:
+                    os.remove(outdated_filename)
+
+            logging.info(f"Pattern Cache: Stored {len(pattern_set)} patterns in {cache_filename}")
+        except OSError as ex:
+            logging.warning(f"Pattern Cache: Could not write cache file: {ex}")
+
+    def touch(self, date: str) -> None:
+
+        # patterns have been confirmed to be unchanged in their source
+        cache_filename = self._find_cache_filename(date)
+        if cache_filename is not None:
+            try:
+                os.utime(cache_filename)
+            except OSError as ex:
+                logging.warning(f"Pattern Cache: Could not touch {cache_filename}: {ex}")
+
+    def _find_cache_filename(self, date: str) -> str | None:
+        cache_filenames = sorted(glob.glob(os.path.join(self._cache_dir, f"patterns-{date}-{self._source_key}-*.cache")), key=os.path.getmtime)
+        if len(cache_filenames) == 0:
+            return None
+
+        return cache_filenames[-1]
+
+    def _content_hash(self, routes: list, patterns: list, geometries: list, payload: bytes) -> str:
+        content_hash = hashlib.sha256()
+        content_hash.update(json.dumps(routes, sort_keys=True).encode('utf-8'))
+        content_hash.update(json.dumps(patterns).encode('utf-8'))
+        content_hash.update(json.dumps(geometries).encode('utf-8'))
+        content_hash.update(payload)
+
+        return content_hash.hexdigest()
@@ -0,0 +1,157 @@
+import logging
+import numpy
+import threading
+import time
+
+from . import geometry
+
+from .geometry import ParallelGeometryEngine
+from .model import PatternSet
+from .patterncache import PatternCache
+
+
+class PatternProvider:
+
+    def __init__(self, otp_url: str, gtfs_filename: str = None, pattern_cache: bool = True, workers: int = 1, executor_factory=None, refresh_interval: float = 3600, merge_tolerance: float = 0.0, **engine_options):
+
+        # patterns are either read from a static GTFS file or requested from OTP,
+        # only the client of the source in use is imported
+        if gtfs_filename is not None:
+            from .gtfsreader import GtfsReader
+
+            self._source = GtfsReader(gtfs_filename)
+            self._cache = PatternCache(self._source.source_key) if pattern_cache else None
+        else:
+            from .otpclient import OtpClient
+
+            self._source = OtpClient(otp_url)
+            self._cache = PatternCache(otp_url) if pattern_cache else None
+
+        # without the persistent cache, patterns are loaded from their source each time they are revalidated
+        self._refresh_interval = refresh_interval if pattern_cache else 0
+        self._workers = workers
+        self._executor_factory = executor_factory
+        self._merge_tolerance = merge_tolerance
+        self._engine_options = engine_options
+
+        # jobs sharing this provider load and match concurrently
+        self._lock = threading.Lock()
+
+        self._date = None
+        self._patterns = None
+        self._shapes = None
+        self._engine = None
+        self._hash = None
+        self._loaded = None
+
+        # patterns of each geometry, ordered by geometry
+        self._geometry_offsets = None
+        self._geometry_patterns = None
+
+    def load(self, date: str, deadline: float = None, revalidate: bool = False) -> tuple:
+        with self._lock:
+            if self._date != date:
+                self._load(date, deadline)
+            elif revalidate and time.monotonic() - self._loaded >= self._refresh_interval:
+                self._load(date, deadline, False)
+
+            return self._patterns, self._hash
+
+    def match(self, incident_shapes) -> tuple:
+
+        # patterns are returned along with the matches, as they
+        # may have been reloaded by another job in the meantime
+        with self._lock:
+            geometry_matches = self._engine.match(incident_shapes)
+            geometry_stretches = self._engine.stretches
+
+            matches = list()
+            stretches = list() if geometry_stretches is not None else None
+            for incident_index, geometry_indices in enumerate(geometry_matches):
+                pattern_indices, order = self._fan_out(geometry_indices)
+                matches.append(pattern_indices)
+
+                if stretches is not None:
+                    stretches.append(geometry_stretches[incident_index][order])
+
+            return self._patterns, matches, self._engine.candidate_count, stretches
+
+    def close(self) -> None:
+        with self._lock:
+            self._source.close()
+
+            if self._engine is not None:
+                self._engine.close()
+                self._engine = None
+
+    def _load(self, date: str, deadline: float = None, use_cache: bool = True) -> None:
+
+        # use pattern geometries of the persistent cache if available and not outdated
+        # otherwise load the active patterns from their source and project their shapes
+        cached_patterns = self._cache.load(date, self._refresh_interval) if self._cache is not None and use_cache else None
+        if cached_patterns is not None:
+            patterns, shapes, pattern_hash = cached_patterns
+        else:
+            patterns = self._source.load_active_pattern(date, deadline)
+            pattern_hash = patterns.content_hash()
+
+            # patterns are revalidated against their source, e.g. to notice a redeployed OTP instance,
+            # but only processed again if they have changed
+            if date == self._date and pattern_hash == self._hash:
+                if self._cache is not None:
+                    self._cache.touch(date)
+
+                self._loaded = time.monotonic()
+                return
+
+            patterns = patterns.deduplicate()
+            shapes = geometry.create_pattern_set_shapes(patterns)
+
+            logging.info(f"Pattern Provider: Found {len(shapes)} distinct geometries of {len(patterns)} patterns")
+
+            if self._cache is not None:
+                self._cache.store(date, patterns, shapes, pattern_hash)
+
+            # coordinates are not needed anymore once the shapes are projected
+            patterns = patterns.without_coordinates()
+
+        # merging similar geometries is not cached, as it depends on the tolerance
+        if self._merge_tolerance > 0 and len(shapes) > 0:
+            shapes, geometry_map = geometry.merge_similar_shapes(shapes, self._merge_tolerance)
+            patterns = PatternSet(patterns.routes, patterns.route_indices, geometry_map[patterns.geometry_indices])
+
+            logging.info(f"Pattern Provider: Merged geometries within {self._merge_tolerance}m into {len(shapes)} geometries")
+
+        # build the geometry engine with a spatial index over all pattern shapes,
+        # so that each incident is only tested against patterns nearby
+        if self._engine is not None:
+            self._engine.close()
+
+        if self._workers > 1:
+            engine = ParallelGeometryEngine(shapes, self._executor_factory(), self._workers, **self._engine_options)
+        else:
+            engine = geometry.create_engine(shapes, **self._engine_options)
+
+        self._date = date
+        self._patterns = patterns
+        self._shapes = shapes
+        self._engine = engine
+        self._hash = pattern_hash
+        self._loaded = time.monotonic()
+
+        self._geometry_patterns = numpy.argsort(patterns.geometry_indices, kind='stable')
+        self._geometry_offsets = numpy.searchsorted(patterns.geometry_indices[self._geometry_patterns], numpy.arange(len(shapes) + 1))
+
+    def _fan_out(self, geometry_indices: numpy.ndarray) -> tuple:
+
+        # each matching geometry is a hit for all patterns using it, patterns are
+        # ordered by their index and returned along with the geometry they stem from
+        counts = self._geometry_offsets[geometry_indices + 1] - self._geometry_offsets[geometry_indices]
+        positions = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts - self._geometry_offsets[geometry_indices], counts)
+
+        pattern_indices = self._geometry_patterns[positions]
+        geometry_order = numpy.repeat(numpy.arange(len(geometry_indices)), counts)
+
+        order = numpy.argsort(pattern_indices, kind='stable')
+
+        return pattern_indices[order], geometry_order[order]
@@ -0,0 +1,129 @@
+import json
+import logging
+import os
+import re
+import tarfile
+import time
+import zipfile
+
+from datetime import datetime
+
+from .metrics import metrics
+
+
+class Replay:
+
+    _timestamp_pattern = re.compile(r'(\d{4})-?(\d{2})-?(\d{2})[T_\-]?(\d{2})[:\-]?(\d{2})[:\-]?(\d{2})')
+    _extensions = ('.geojson', '.json')
+
+    def __init__(self, source: str, speed: float = 0.0):
+        self._source = source
+        self._speed = speed
+
+    def run(self, matcher, output_filename: str, mqtt_uri: str, mqtt_expiration: int) -> dict:
+        cycles = list()
+
+        replay_start = time.perf_counter()
+        first_timestamp = None
+        for timestamp, name, geojson in self._read_snapshots():
+
+            # with a speed-up factor, snapshots are replayed relative to the first one,
+            # otherwise as fast as possible
+            if first_timestamp is None:
+                first_timestamp = timestamp
+
+            if self._speed > 0:
+                delay = (timestamp - first_timestamp) / self._speed - (time.perf_counter() - replay_start)
+                if delay > 0:
+                    time.sleep(delay)
+
+            metrics.start_cycle()
+            try:
+                matcher.match(geojson, output_filename, mqtt_uri, mqtt_expiration)
+            finally:
+                cycle_stats = metrics.end_cycle()
+
+            cycle_stats['snapshot'] = name
+            cycle_stats['timestamp'] = datetime.fromtimestamp(timestamp).isoformat()
+            cycles.append(cycle_stats)
+
+            logging.info(f"replayed {name} in {cycle_stats['duration']:.3f}s")
+
+        replay_duration = time.perf_counter() - replay_start
+
+        return {
+            'source': self._source,
+            'speed': self._speed,
+            'summary': self._create_summary(cycles, replay_duration),
+            'cycles': cycles
+        }
+
+    def _create_summary(self, cycles: list, replay_duration: float) -> dict:
+        latencies = sorted(c['duration'] for c in cycles)
+        incidents = sum(c['counts'].get('incidents', 0) for c in cycles)
+        processing_duration = sum(latencies)
+
+        summary = {
+            'cycles': len(cycles),
+            'incidents': incidents,
+            'alerts_created': sum(c['counts'].get('alerts_created', 0) for c in cycles),
+            'alerts_changed': sum(c['counts'].get('alerts_changed', 0) for c in cycles),
+            'alerts_deleted': sum(c['counts'].get('alerts_deleted', 0) for c in cycles),
+            'duration': round(replay_duration, 6),
+            'processing_duration': round(processing_duration, 6),
+            'incidents_per_second': round(incidents / processing_duration, 1) if processing_duration > 0 else None,
+            'cycles_per_second': round(len(cycles) / processing_duration, 3) if processing_duration > 0 else None
+        }
+
+        if len(latencies) > 0:
+            summary['latency'] = {
+                'min': latencies[0],
+                'mean': round(processing_duration / len(latencies), 6),
+                'p50': latencies[int(0.5 * (len(latencies) - 1))],
+                'p95': latencies[int(0.95 * (len(latencies) - 1))],
+                'max': latencies[-1]
+            }
+
+        return summary
+
+    def _read_snapshots(self):
+        if os.path.isdir(self._source):
+            members = list()
+            for filename in os.listdir(self._source):
+                if filename.endswith(self._extensions):
+                    path = os.path.join(self._source, filename)
+                    members.append((self._parse_timestamp(filename, os.path.getmtime(path)), filename, path))
+
+            for timestamp, name, path in sorted(members):
+                with open(path, 'rb') as snapshot_file:
+                    yield timestamp, name, json.loads(snapshot_file.read())
+
+        elif zipfile.is_zipfile(self._source):
+            with zipfile.ZipFile(self._source) as archive:
+                members = [(self._parse_timestamp(m.filename, time.mktime(m.date_time + (0, 0, -1))), m.filename) for m in archive.infolist() if m.filename.endswith(self._extensions)]
+
+                for timestamp, name in sorted(members):
+                    yield timestamp, name, json.loads(archive.read(name))
+
+        elif tarfile.is_tarfile(self._source):
+            with tarfile.open(self._source) as archive:
+                members = [(self._parse_timestamp(m.name, m.mtime), m.name, m) for m in archive.getmembers() if m.isfile() and m.name.endswith(self._extensions)]
+
+                for timestamp, name, member in sorted(members, key=lambda m: m[0:2]):
+                    yield timestamp, name, json.loads(archive.extractfile(member).read())
+
+        else:
+            raise ValueError(f"{self._source} is neither a directory nor a ZIP or TAR archive")
+
+    def _parse_timestamp(self, name: str, fallback: float) -> float:
+
+        # snapshots are ordered by the timestamp in their name,
+        # e.g. incidents-20250101T120000.geojson, or by their modification time
+        match = self._timestamp_pattern.search(os.path.basename(name))
+        if match is not None:
+            try:
+                return datetime(*[int(g) for g in match.groups()]).timestamp()
+            except ValueError:
+                pass
+
+        return fallback
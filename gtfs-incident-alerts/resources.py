@@ -0,0 +1,76 @@
+import multiprocessing
+import threading
+
+from concurrent.futures import ProcessPoolExecutor
+
+from .patternprovider import PatternProvider
+from .templates import TemplateSet
+
+
+class SharedResources:
+
+    def __init__(self, pattern_cache: bool = True, workers: int = 1, pattern_refresh: float = 3600):
+        self._pattern_cache = pattern_cache
+        self._pattern_refresh = pattern_refresh
+        self._workers = workers
+
+        # jobs with the same pattern source and engine options, the same templates
+        # or the same broker share one instance of them
+        self._pattern_providers = dict()
+        self._template_sets = dict()
+        self._mqtt_connections = dict()
+
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+        self._lock = threading.Lock()
+
+    def get_pattern_provider(self, otp_url: str, gtfs_filename: str = None, **engine_options) -> PatternProvider:
+        key = (gtfs_filename, otp_url if gtfs_filename is None else None, tuple(sorted(engine_options.items())))
+
+        with self._lock:
+            if key not in self._pattern_providers:
+                self._pattern_providers[key] = PatternProvider(otp_url, gtfs_filename, self._pattern_cache, self._workers, self._get_executor, self._pattern_refresh, **engine_options)
+
+            return self._pattern_providers[key]
+
+    def get_template_set(self, filename: str) -> TemplateSet:
+        with self._lock:
+            if filename not in self._template_sets:
+                self._template_sets[filename] = TemplateSet(filename)
+
+            return self._template_sets[filename]
+
+    def get_mqtt_connection(self, host: str, port: str, username: str, password: str):
+        from .mqtt import MqttConnection
+
+        key = (host, int(port), username, password)
+
+        with self._lock:
+            if key not in self._mqtt_connections:
+                self._mqtt_connections[key] = MqttConnection(host, port, username, password)
+
+            return self._mqtt_connections[key]
+
+    def close(self) -> None:
+        with self._lock:
+            for pattern_provider in self._pattern_providers.values():
+                pattern_provider.close()
+
+            self._pattern_providers = dict()
+            self._template_sets = dict()
+            self._mqtt_connections = dict()
+
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+
+        # worker processes are started once and shared by all pattern providers
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self._workers, mp_context=multiprocessing.get_context('spawn'))
+
+            return self._executor
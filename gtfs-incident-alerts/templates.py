@@ -0,0 +1,114 @@
+import hashlib
+import logging
+import os
+import threading
+import yaml
+
+from mako.template import Template
+
+
+class ServiceAlertTemplate:
+
+    def __init__(self, template: dict):
+        self.name = template['name']
+        self.cause = template['cause']
+        self.effect = template['effect']
+
+        # resolve each condition into the set of accepted codes and its minimum delay
+        self.conditions = list()
+        for template_condition in template['conditions']:
+            codes = frozenset([template_condition['code']] + list(template_condition.get('or', [])))
+            self.conditions.append((codes, template_condition.get('delay')))
+
+        # compile all texts once
+        self.texts = dict()
+        for type in ['url', 'header', 'description']:
+            if type in template:
+                self.texts[type] = {lang: Template(text) for lang, text in template[type].items()}
+
+    def available(self, incident_codes: set, incident_delay: int | None) -> bool:
+        available = False
+        for codes, delay in self.conditions:
+            if not codes.isdisjoint(incident_codes):
+                available = True
+
+            if delay is not None and incident_delay is not None and incident_delay < delay:
+                available = False
+
+        return available
+
+
+class TemplateRuleEngine:
+
+    def __init__(self, templates: list):
+        self._templates = [ServiceAlertTemplate(template) for template in templates]
+
+        # inverted index of all templates which may become available by a certain code
+        self._code_index = dict()
+        for index, template in enumerate(self._templates):
+            for codes, _ in template.conditions:
+                for code in codes:
+                    template_indices = self._code_index.setdefault(code, list())
+                    if index not in template_indices:
+                        template_indices.append(index)
+
+    def find_template(self, incident: dict) -> ServiceAlertTemplate | None:
+        if incident['properties']['events'] is None:
+            return None
+
+        incident_codes = set(e['code'] for e in incident['properties']['events'])
+        incident_delay = incident['properties'].get('delay')
+
+        # only templates with at least one code of the incident can be available,
+        # test them in order of their definition as the first one wins
+        template_indices = set()
+        for code in incident_codes:
+            template_indices.update(self._code_index.get(code, []))
+
+        for index in sorted(template_indices):
+            template = self._templates[index]
+            if template.available(incident_codes, incident_delay):
+                return template
+
+        return None
+
+
+class TemplateSet:
+
+    def __init__(self, filename: str):
+        self.filename = filename
+
+        self.engine = None
+        self.hash = None
+
+        self._mtime = None
+        self._lock = threading.Lock()
+
+        self.reload()
+
+    def reload(self) -> tuple:
+
+        # the templates are shared between jobs, so only one of them reloads a changed file
+        # and each one gets the engine along with the hash it belongs to
+        with self._lock:
+            mtime = os.stat(self.filename).st_mtime_ns
+            if mtime == self._mtime:
+                return self.engine, self.hash
+
+            with open(self.filename, 'rb') as template_file:
+                template_content = template_file.read()
+
+            self._mtime = mtime
+
+            templates_hash = hashlib.sha256(template_content).hexdigest()
+            if templates_hash == self.hash:
+                return self.engine, self.hash
+
+            templates = yaml.safe_load(template_content.decode('utf-8'))
+            if self.engine is not None:
+                logging.info(f"templates {self.filename} changed, reloading")
+
+            self.engine = TemplateRuleEngine(templates['templates'])
+            self.hash = templates_hash
+
+            return self.engine, self.hash
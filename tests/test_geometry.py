@@ -0,0 +1,51 @@
+import importlib
+import numpy
+import os
+import shapely
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+geometry = importlib.import_module('gtfs-incident-alerts.geometry')
+
+
+def _match(engine_class, pattern_shapes, incident_shapes):
+    engine = engine_class(pattern_shapes)
+    return [m.tolist() for m in engine.match(numpy.asarray(incident_shapes, dtype=object))], engine.stretches
+
+@pytest.mark.parametrize('engine_class', [geometry.GeometryEngine, geometry.SegmentGeometryEngine])
+def test_out_and_back_pattern_counts_its_overlap_once(engine_class):
+
+    # a terminal spur runs 30m out and back on the same street
+    pattern_shapes = [shapely.LineString([(0, 0), (30, 0), (0, 0)])]
+    incident_shapes = [shapely.LineString([(0, 0), (30, 0)])]
+
+    matches, _ = _match(engine_class, pattern_shapes, incident_shapes)
+
+    assert matches == [[]]
+
+def test_segment_engine_matches_like_whole_patterns():
+    pattern_shapes = [
+        shapely.LineString([(0, 0), (30, 0), (0, 0)]),
+        shapely.LineString([(0, 0), (60, 0), (0, 0)]),
+        shapely.LineString([(0, 0), (20, 0), (20, 20), (0, 20), (0, 0), (60, 0)]),
+        shapely.LineString([(25, -50), (25, 50)]),
+        shapely.LineString([(0, 10), (100, 10)])
+    ]
+
+    incident_shapes = [
+        shapely.LineString([(0, 0), (30, 0)]),
+        shapely.LineString([(0, 0), (50, 0)]),
+        shapely.LineString([(0, 10), (50, 10)])
+    ]
+
+    whole_matches, _ = _match(geometry.GeometryEngine, pattern_shapes, incident_shapes)
+    segment_matches, segment_stretches = _match(geometry.SegmentGeometryEngine, pattern_shapes, incident_shapes)
+
+    assert segment_matches == whole_matches
+    assert segment_matches[1] == [1, 2]
+
+    # the overlap of the out-and-back pattern is the length of the street, not twice of it
+    assert segment_stretches[1][0][2] == pytest.approx(55.0)